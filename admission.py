@@ -0,0 +1,179 @@
+"""
+Admission control for merges
+Every merge is priced before it runs, from the page counts and sizes the
+upload manifest already has: one unit per output page plus one per MB of
+input. Each client has a token bucket that refills at a steady rate up to
+a burst; a merge is admitted when the bucket holds its cost (or the whole
+burst, for merges bigger than that) and then takes its full cost, so a
+huge job leaves its client waiting in proportion. On top of that the
+number of admitted merges that have not finished is capped for the
+server. Rejections happen before any work is done.
+
+Buckets and admitted merges live in a SQLite table, so every server
+process on the host enforces the same limits. An admitted merge is
+recorded with the pid of its process; merges of a process that died
+without releasing them are dropped the next time the cap is checked or
+the load is read.
+"""
+
+import math
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+# Input bytes that cost as much as one output page
+BYTES_PER_UNIT = 1024 * 1024
+# Buckets kept before those that have refilled completely are dropped
+MAX_CLIENTS = 10000
+# Seconds a client is told to wait when the server, not the client, is at its limit
+CAPACITY_RETRY_AFTER = 5
+
+
+def merge_cost(pages, nbytes):
+    """Cost units of a merge of pages output pages from nbytes of input"""
+    return pages + nbytes / BYTES_PER_UNIT
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Rejected(Exception):
+    """Raised when a merge is not admitted
+
+    status is 429 when the client is over its rate and 503 when the
+    server is at capacity; retry_after is in whole seconds.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """An admitted merge; release() it once the merge has finished"""
+
+    def __init__(self, control, ticket_id, cost):
+        self.control = control
+        self.ticket_id = ticket_id
+        self.cost = cost
+        self._released = False
+
+    def release(self):
+        """Give the merge's slots back; later calls do nothing"""
+        if self._released:
+            return
+        self._released = True
+        self.control._release(self)
+
+
+class AdmissionControl:
+    """Per-client token buckets and a cap on merges in flight, shared through SQLite
+
+    rate is in cost units per second; 0 turns the per-client limit off,
+    as max_in_flight 0 turns the cap off.
+    """
+
+    def __init__(self, db_path, rate, burst, max_in_flight):
+        self.db_path = db_path
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS in_flight ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL, '
+                         'slots INTEGER NOT NULL, cost REAL NOT NULL, admitted REAL NOT NULL)')
+            self._drop_dead(conn)
+
+    def _connect(self):
+        # Autocommit; admit() takes the write lock itself with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def _drop_dead(self, conn):
+        # Merges of processes that died before releasing them
+        for (pid,) in conn.execute('SELECT DISTINCT pid FROM in_flight').fetchall():
+            if not _alive(pid):
+                conn.execute('DELETE FROM in_flight WHERE pid = ?', (pid,))
+
+    def _in_flight(self, conn):
+        return conn.execute('SELECT COALESCE(SUM(slots), 0) FROM in_flight').fetchone()[0]
+
+    def _take(self, conn, client, cost, now):
+        """Charge cost to client's bucket; raises Rejected if it holds too little"""
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE client = ?',
+                           (client,)).fetchone()
+        if row is None:
+            tokens = self.burst
+            if conn.execute('SELECT COUNT(*) FROM buckets').fetchone()[0] >= MAX_CLIENTS:
+                # A full bucket is the same as no bucket
+                conn.execute('DELETE FROM buckets WHERE tokens + (? - updated) * ? >= ?',
+                             (now, self.rate, self.burst))
+        else:
+            tokens = min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+        needed = min(cost, self.burst)
+        if tokens < needed:
+            retry_after = max(1, math.ceil((needed - tokens) / self.rate))
+            raise Rejected(f"Rate limit exceeded, retry in {retry_after}s", 429, retry_after)
+        conn.execute('INSERT OR REPLACE INTO buckets (client, tokens, updated) VALUES (?, ?, ?)',
+                     (client, tokens - cost, now))
+
+    def admit(self, client, cost, slots=1):
+        """Ticket for a merge of cost units by client; raises Rejected
+
+        slots is the number of merges it counts as against the cap, e.g.
+        the outputs of a batch; it is capped at max_in_flight, so a batch
+        bigger than that is admitted only when nothing else is running.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.max_in_flight:
+                    slots = min(slots, self.max_in_flight)
+                    if self._in_flight(conn) + slots > self.max_in_flight:
+                        self._drop_dead(conn)
+                    if self._in_flight(conn) + slots > self.max_in_flight:
+                        raise Rejected(f"Too many merges in progress ({self.max_in_flight})",
+                                       503, CAPACITY_RETRY_AFTER)
+                if self.rate:
+                    self._take(conn, client, cost, now)
+                ticket_id = conn.execute('INSERT INTO in_flight (pid, slots, cost, admitted) '
+                                         'VALUES (?, ?, ?, ?)',
+                                         (os.getpid(), slots, cost, now)).lastrowid
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return Ticket(self, ticket_id, cost)
+
+    def _release(self, ticket):
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM in_flight WHERE id = ?', (ticket.ticket_id,))
+
+    def load(self):
+        """Merges in flight, their cost and the share of the cap they use"""
+        with closing(self._connect()) as conn:
+            self._drop_dead(conn)
+            in_flight, cost = conn.execute('SELECT COALESCE(SUM(slots), 0), COALESCE(SUM(cost), 0) '
+                                           'FROM in_flight').fetchone()
+            clients = conn.execute('SELECT COUNT(*) FROM buckets').fetchone()[0]
+        return {
+            'merges_in_flight': in_flight,
+            'max_merges_in_flight': self.max_in_flight,
+            'cost_in_flight': round(cost, 1),
+            'utilization': (round(in_flight / self.max_in_flight, 3)
+                            if self.max_in_flight else 0.0),
+            'clients': clients,
+        }
@@ -1,37 +1,233 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_file, session
+from flask import Flask, Response, render_template, redirect, url_for, flash, request, jsonify, session, send_file, g, make_response
+import logging
 import os
+import time
 import uuid
-from datetime import datetime
-from werkzeug.utils import secure_filename
-from PyPDF2 import PdfReader, PdfWriter
+import zipfile
+from datetime import datetime, timedelta
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import secure_filename, send_from_directory
 import json
+from urllib.parse import quote
+
+from admission import AdmissionControl, Rejected, merge_cost
+from chunked_upload import ChunkedUploads, ChunkRejected
+from ingest import IngestRequest, UploadRejected, save_upload
+from jobs import JobQueue, QueueFull, write_status
+from merger import COMPRESSION_PROFILES, iter_merge, MergeError, MergeSpec
+from parse_pool import ParsePool
+from pdf_cache import PdfInfoCache
+from expiry import CleanupService, ExpiryIndex
+from history_store import MergeHistory
+import metrics
+from metrics import stage
+from result_cache import MergeResultCache, merge_key
+from session_store import create_session_store
+from thumbnails import ThumbnailCache, renderer_available
+
+# LOG_LEVEL / LOG_FORMAT, see metrics.configure_logging
+metrics.configure_logging()
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.request_class = IngestRequest
 app.secret_key = 'pdf-merger-secret-key-2024'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+app.config['JOBS_FOLDER'] = 'jobs'
+app.config['CACHE_FOLDER'] = 'cache'
+app.config['DATA_FOLDER'] = 'data'
+app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'sqlite')  # 'sqlite' or 'memory'
+app.config['PDF_INFO_CACHE_SIZE'] = 10000
+app.config['MERGE_CACHE_SIZE'] = 1024 * 1024 * 1024  # 1GB of cached merge outputs
+app.config['MAX_FILE_SIZE'] = 50 * 1024 * 1024  # 50MB max per uploaded file (and per chunk)
+app.config['MAX_CHUNKED_FILE_SIZE'] = int(os.environ.get('MAX_CHUNKED_FILE_SIZE', 2 * 1024 * 1024 * 1024))
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # suggested to chunked upload clients
+app.config['BATCH_MAX_OUTPUTS'] = int(os.environ.get('BATCH_MAX_OUTPUTS', 1000))
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 1GB max per upload request
+# Hand downloads to the front proxy: None, 'x-sendfile' or 'x-accel-redirect'
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD') or None
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-output/')
+app.config['DOWNLOAD_MAX_AGE'] = 0  # output names get reused, so always revalidate
+app.config['PARSE_WORKERS'] = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 2))
+app.config['PARSE_TIMEOUT'] = int(os.environ.get('PARSE_TIMEOUT', 30))  # seconds per file
+app.config['MERGE_WORKERS'] = int(os.environ.get('MERGE_WORKERS', 2))
+app.config['MERGE_QUEUE_DEPTH'] = int(os.environ.get('MERGE_QUEUE_DEPTH', 32))
+app.config['THUMBNAIL_WIDTH'] = 200  # pixels
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+app.config['UPLOAD_TTL'] = int(os.environ.get('UPLOAD_TTL', 24 * 3600))  # seconds after last use
+app.config['OUTPUT_TTL'] = int(os.environ.get('OUTPUT_TTL', 48 * 3600))  # more time to download
+app.config['CLEANUP_INTERVAL'] = int(os.environ.get('CLEANUP_INTERVAL', 300))  # 0 disables the thread
+app.config['HISTORY_MAX_ROWS'] = int(os.environ.get('HISTORY_MAX_ROWS', 1000000))
+app.config['HISTORY_RETENTION_DAYS'] = int(os.environ.get('HISTORY_RETENTION_DAYS', 90))
+app.config['HISTORY_PAGE_SIZE'] = 50
+app.config['HISTORY_MAX_PAGE_SIZE'] = 500
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 64))  # route threads in asgi.py
+# Merge admission: cost units (pages + input MB) per second and burst per client, 0 = no limit
+app.config['RATE_LIMIT_RATE'] = float(os.environ.get('RATE_LIMIT_RATE', 100))
+app.config['RATE_LIMIT_BURST'] = float(os.environ.get('RATE_LIMIT_BURST', 2000))
+app.config['MAX_MERGES_IN_FLIGHT'] = int(os.environ.get('MAX_MERGES_IN_FLIGHT',
+                                                        app.config['MERGE_QUEUE_DEPTH']))
+app.config['CLIENT_ID_HEADER'] = os.environ.get('CLIENT_ID_HEADER') or None  # else the remote address
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))  # that append X-Forwarded-For
+app.config['LOAD_SHED_THRESHOLD'] = float(os.environ.get('LOAD_SHED_THRESHOLD', 0.8))
+
+# The remote address is the one the nearest trusted proxy saw, not what the client claims
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+if app.config['DOWNLOAD_OFFLOAD'] not in (None, 'x-sendfile', 'x-accel-redirect'):
+    raise ValueError(f"Unknown DOWNLOAD_OFFLOAD: {app.config['DOWNLOAD_OFFLOAD']}. "
+                     "Use x-sendfile or x-accel-redirect")
 
 # Create directories if they don't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
-# Store merge history in memory (use database in production)
-merge_history = []
+# Merge history, shared by all server processes
+merge_history = MergeHistory(os.path.join(app.config['DATA_FOLDER'], 'history.sqlite3'),
+                             max_rows=app.config['HISTORY_MAX_ROWS'],
+                             max_age_days=app.config['HISTORY_RETENTION_DAYS'])
+
+# Background merge workers used by the API
+merge_queue = JobQueue(app.config['JOBS_FOLDER'],
+                       workers=app.config['MERGE_WORKERS'],
+                       max_depth=app.config['MERGE_QUEUE_DEPTH'],
+                       history=merge_history)
+
+# PDF metadata keyed by content hash, shared by upload, /merge and /recover
+pdf_info_cache = PdfInfoCache(os.path.join(app.config['CACHE_FOLDER'], 'pdf_info.sqlite3'),
+                              max_entries=app.config['PDF_INFO_CACHE_SIZE'])
+
+# Process pool shared by all requests for parsing uploaded PDFs
+parse_pool = ParsePool(workers=app.config['PARSE_WORKERS'], timeout=app.config['PARSE_TIMEOUT'])
+
+# Expiry times of uploads, outputs and job status files, swept in the background
+expiry_index = ExpiryIndex(os.path.join(app.config['DATA_FOLDER'], 'expiry.sqlite3'))
+
+# Outputs of earlier merges, keyed by input hashes and options
+merge_result_cache = MergeResultCache(os.path.join(app.config['CACHE_FOLDER'], 'merge_results.sqlite3'),
+                                      os.path.join(app.config['OUTPUT_FOLDER'], '.cache'),
+                                      max_bytes=app.config['MERGE_CACHE_SIZE'],
+                                      expiry=expiry_index, ttl=app.config['OUTPUT_TTL'])
+
+# Page thumbnails for the merge page, rendered on their own small pool
+thumbnail_cache = ThumbnailCache(os.path.join(app.config['CACHE_FOLDER'], 'thumbnails'),
+                                 ParsePool(workers=app.config['THUMBNAIL_WORKERS'],
+                                           timeout=app.config['PARSE_TIMEOUT']),
+                                 width=app.config['THUMBNAIL_WIDTH'],
+                                 expiry=expiry_index, ttl=app.config['UPLOAD_TTL'])
+
+# Resumable uploads in progress, moved into their session folder when finalized
+chunked_uploads = ChunkedUploads(os.path.join(app.config['UPLOAD_FOLDER'], '.chunked'))
+
+# Upload manifests; the session cookie only holds the upload_id
+session_store = create_session_store(app.config['SESSION_STORE'], app.config['DATA_FOLDER'])
+
+cleanup_service = CleanupService(expiry_index, interval=app.config['CLEANUP_INTERVAL'],
+                                 session_store=session_store,
+                                 session_max_age=app.config['UPLOAD_TTL'])
+cleanup_service.start()
+
+# Per-client rate limits and the cap on merges in flight, checked before a merge starts
+admission = AdmissionControl(os.path.join(app.config['DATA_FOLDER'], 'admission.sqlite3'),
+                             app.config['RATE_LIMIT_RATE'], app.config['RATE_LIMIT_BURST'],
+                             app.config['MAX_MERGES_IN_FLIGHT'])
+
+metrics.REGISTRY.add_collector(lambda: metrics.QUEUE_DEPTH.set(merge_queue.depth()))
+
+def collect_admission():
+    load = admission.load()
+    metrics.MERGES_IN_FLIGHT.set(load['merges_in_flight'])
+    metrics.MERGE_COST_IN_FLIGHT.set(load['cost_in_flight'])
+
+metrics.REGISTRY.add_collector(collect_admission)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if 'request_started' in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def end_request(error=None):
+    metrics.REQUESTS_IN_FLIGHT.dec()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'pdf'
 
-def get_pdf_info(filepath):
-    try:
-        reader = PdfReader(filepath, strict=False)
-        return {
-            'pages': len(reader.pages),
-            'size': os.path.getsize(filepath)
-        }
-    except Exception as e:
-        print(f"DEBUG: PDF info error for {filepath}: {str(e)}")
-        return {'pages': 0, 'size': 0}
+def get_pdf_infos(items):
+    """Page count, size and other metadata of (filepath, sha256) pairs
+
+    Served from the cache when possible, misses are parsed in parallel.
+    Results come back in the order of items; a file that cannot be read
+    gets {'pages': 0, 'size': 0}.
+    """
+    infos = []
+    with stage('pdf_info'):
+        results = pdf_info_cache.lookup_many(items, parse_pool)
+    for (filepath, _), info in zip(items, results):
+        if isinstance(info, Exception):
+            log.warning('PDF info error for %s: %s', filepath, info)
+            metrics.STAGE_ERRORS.inc(stage='pdf_info')
+            info = {'pages': 0, 'size': 0}
+        infos.append(info)
+    return infos
+
+def merge_cache_key(file_infos, options):
+    """Result cache key for files in merge order, or None if a hash is unknown"""
+    digests = [info.get('sha256') for info in file_infos]
+    if not digests or None in digests:
+        return None
+    return merge_key(digests, options)
+
+def get_manifest(upload_id=None):
+    """Server-side manifest of the given or current upload session, or None"""
+    upload_id = upload_id or session.get('upload_id')
+    return session_store.get(upload_id) if upload_id else None
+
+def save_manifest(upload_id, manifest):
+    """Store a manifest; any use of a session also postpones its expiry"""
+    session_store.set(upload_id, manifest)
+    expiry_index.schedule(os.path.join(app.config['UPLOAD_FOLDER'], upload_id),
+                          app.config['UPLOAD_TTL'], kind='upload')
+
+def touch_session(upload_id):
+    """Postpone the expiry of a session in use without rewriting its manifest"""
+    session_store.touch(upload_id)
+    expiry_index.schedule(os.path.join(app.config['UPLOAD_FOLDER'], upload_id),
+                          app.config['UPLOAD_TTL'], kind='upload')
+
+def schedule_output(output_path, task_id=None):
+    """Expire a merge output (and the status file of its job) after OUTPUT_TTL"""
+    expiry_index.schedule(output_path, app.config['OUTPUT_TTL'], kind='output')
+    if task_id:
+        expiry_index.schedule(os.path.join(app.config['JOBS_FOLDER'], f"{task_id}.json"),
+                              app.config['OUTPUT_TTL'], kind='job')
+
+def scan_session_folder(session_folder):
+    """Rebuild the uploaded file list of a session from its folder"""
+    filenames = [f for f in os.listdir(session_folder) if f.endswith('.pdf')]
+    paths = [os.path.join(session_folder, filename) for filename in filenames]
+    uploaded_files = []
+    for filename, filepath, pdf_info in zip(filenames, paths,
+                                            get_pdf_infos([(path, None) for path in paths])):
+        uploaded_files.append({
+            'name': filename,
+            'path': filepath,
+            'pages': pdf_info['pages'],
+            'size': f"{pdf_info['size'] / 1024:.1f} KB",
+            'sha256': pdf_info.get('sha256')
+        })
+    return uploaded_files
 
 @app.route('/')
 def index():
@@ -42,133 +238,153 @@ def index():
 def upload_files():
     """Handle file uploads"""
     try:
-        print("DEBUG: Upload request received")
-        print(f"DEBUG: Request files: {list(request.files.keys())}")
-        print(f"DEBUG: Request form: {dict(request.form)}")
+        # Parsing the body is what streams the file parts to disk
+        with stage('upload_save'):
+            files = request.files.getlist('files')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Upload request received, files: %s, form: %s',
+                      list(request.files.keys()), dict(request.form))
         
         if 'files' not in request.files:
-            print("DEBUG: No 'files' key in request.files")
+            log.debug("No 'files' key in request.files")
             flash('No files selected', 'error')
             return redirect(url_for('index'))
         
-        files = request.files.getlist('files')
-        print(f"DEBUG: Found {len(files)} files")
+        log.debug('Found %s files', len(files))
         
         if not files or files[0].filename == '':
-            print("DEBUG: No files or empty filename")
+            log.debug('No files or empty filename')
             flash('No files selected', 'error')
             return redirect(url_for('index'))
         
         # Create session ID for this upload
         session_id = str(uuid.uuid4())
         session['upload_id'] = session_id
-        session['merge_order'] = request.form.get('merge_order', 'filename')
-        session['output_name'] = request.form.get('output_name', 'merged.pdf')
         
-        print(f"DEBUG: Session ID: {session_id}")
+        log.debug('Session ID: %s', session_id)
         
         # Create session folder
         session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
         os.makedirs(session_folder, exist_ok=True)
-        print(f"DEBUG: Created session folder: {session_folder}")
+        expiry_index.schedule(session_folder, app.config['UPLOAD_TTL'], kind='upload')
+        log.debug('Created session folder: %s', session_folder)
         
-        uploaded_files = []
+        saved = []
         for i, file in enumerate(files):
-            print(f"DEBUG: Processing file {i+1}: {file.filename}")
+            log.debug('Processing file %s: %s', i+1, file.filename)
             if file and file.filename and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 filepath = os.path.join(session_folder, filename)
-                file.save(filepath)
-                print(f"DEBUG: Saved file: {filepath}")
-                
-                # Validate and get PDF info
-                pdf_info = get_pdf_info(filepath)
-                
-                # Skip corrupted PDFs
-                if pdf_info['pages'] == 0:
-                    print(f"DEBUG: Skipping corrupted PDF: {filename}")
-                    os.remove(filepath)  # Remove corrupted file
+                try:
+                    ingest_info = save_upload(file, filepath)
+                except UploadRejected as e:
+                    log.debug('Rejected %s: %s', filename, e)
+                    metrics.STAGE_ERRORS.inc(stage='upload_save')
                     continue
-                
-                uploaded_files.append({
-                    'name': filename,
-                    'path': filepath,
-                    'pages': pdf_info['pages'],
-                    'size': f"{pdf_info['size'] / 1024:.1f} KB"
-                })
-                print(f"DEBUG: File info - Pages: {pdf_info['pages']}, Size: {pdf_info['size']} bytes")
+                log.debug('Saved file: %s', filepath)
+                metrics.BYTES.inc(ingest_info['size'], direction='uploaded')
+                saved.append((filename, filepath, ingest_info.get('sha256')))
             else:
-                print(f"DEBUG: Skipped invalid file: {file.filename if file else 'None'}")
+                log.debug('Skipped invalid file: %s', file.filename if file else 'None')
+        
+        # Validate and get PDF info for the whole batch in parallel
+        pdf_infos = get_pdf_infos([(filepath, sha256) for _, filepath, sha256 in saved])
+        
+        uploaded_files = []
+        for (filename, filepath, _), pdf_info in zip(saved, pdf_infos):
+            # Skip corrupted PDFs
+            if pdf_info['pages'] == 0:
+                log.debug('Skipping corrupted PDF: %s', filename)
+                os.remove(filepath)  # Remove corrupted file
+                continue
+            
+            uploaded_files.append({
+                'name': filename,
+                'path': filepath,
+                'pages': pdf_info['pages'],
+                'size': f"{pdf_info['size'] / 1024:.1f} KB",
+                'sha256': pdf_info['sha256']
+            })
+            log.debug('File info - Pages: %s, Size: %s bytes', pdf_info['pages'], pdf_info['size'])
         
         if not uploaded_files:
-            print("DEBUG: No valid PDF files uploaded")
+            log.debug('No valid PDF files uploaded')
             flash('No valid PDF files uploaded. Please select PDF files only.', 'error')
             return redirect(url_for('index'))
         
-        session['uploaded_files'] = uploaded_files
-        print(f"DEBUG: Stored {len(uploaded_files)} files in session")
+        save_manifest(session_id, {
+            'files': uploaded_files,
+            'merge_order': request.form.get('merge_order', 'filename'),
+            'output_name': request.form.get('output_name', 'merged.pdf')
+        })
+        log.debug('Stored %s files in session store', len(uploaded_files))
+        thumbnail_cache.prewarm([(f['path'], f['sha256'], 0) for f in uploaded_files])
         flash(f'{len(uploaded_files)} PDF files uploaded successfully!', 'success')
         return redirect(url_for('merge'))
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"DEBUG: Upload failed with error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception('Upload failed with error: %s', e)
         flash(f'Upload failed: {str(e)}', 'error')
         return redirect(url_for('index'))
 
 @app.route('/merge')
 def merge():
     """Show merge options page"""
-    print(f"DEBUG: Session keys: {list(session.keys())}")
-    print(f"DEBUG: Session upload_id: {session.get('upload_id', 'None')}")
+    upload_id = session.get('upload_id')
+    log.debug('Session upload_id: %s', upload_id or 'None')
     
-    if 'uploaded_files' not in session:
-        print("DEBUG: No uploaded_files in session, checking for existing uploads...")
-        
-        # Try to recover from existing uploads directory
-        upload_id = session.get('upload_id')
-        if upload_id:
-            session_folder = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
-            if os.path.exists(session_folder):
-                print(f"DEBUG: Found existing session folder: {session_folder}")
-                # Rebuild file list from directory
-                uploaded_files = []
-                for filename in os.listdir(session_folder):
-                    if filename.endswith('.pdf'):
-                        filepath = os.path.join(session_folder, filename)
-                        pdf_info = get_pdf_info(filepath)
-                        uploaded_files.append({
-                            'name': filename,
-                            'path': filepath,
-                            'pages': pdf_info['pages'],
-                            'size': f"{pdf_info['size'] / 1024:.1f} KB"
-                        })
-                
-                if uploaded_files:
-                    session['uploaded_files'] = uploaded_files
-                    print(f"DEBUG: Recovered {len(uploaded_files)} files from session folder")
-                else:
-                    flash('No files uploaded. Please upload files first.', 'error')
-                    return redirect(url_for('index'))
-            else:
-                flash('No files uploaded. Please upload files first.', 'error')
-                return redirect(url_for('index'))
-        else:
+    manifest = get_manifest(upload_id)
+    if not manifest or not manifest.get('files'):
+        log.debug('No manifest in session store, checking for existing uploads...')
+        
+        # Last resort (e.g. memory store after a restart): rebuild from the uploads directory
+        session_folder = os.path.join(app.config['UPLOAD_FOLDER'], upload_id) if upload_id else None
+        uploaded_files = scan_session_folder(session_folder) if session_folder and os.path.exists(session_folder) else []
+        if not uploaded_files:
             flash('No files uploaded. Please upload files first.', 'error')
             return redirect(url_for('index'))
+        manifest = {'files': uploaded_files, 'merge_order': 'filename'}
+        save_manifest(upload_id, manifest)
+        log.debug('Recovered %s files from session folder', len(uploaded_files))
     
-    files = session['uploaded_files']
-    print(f"DEBUG: Found {len(files)} files in session")
+    files = manifest['files']
+    log.debug('Found %s files in session', len(files))
     
-    # Sort files based on merge order
-    merge_order = session.get('merge_order', 'filename')
+    # Sort files based on merge order; stored so /process merges what is shown
+    merge_order = manifest.get('merge_order', 'filename')
     if merge_order == 'filename':
         files.sort(key=lambda x: x['name'])
+        manifest['merge_order'] = 'custom'
+        save_manifest(upload_id, manifest)
     elif merge_order == 'upload_order':
         pass  # Keep original order
     
-    return render_template('simple_merge.html', files=files, file_count=len(files))
+    return render_template('simple_merge.html', files=files, file_count=len(files),
+                           upload_id=upload_id)
+
+@app.route('/thumbnail/<session_id>/<filename>')
+def thumbnail(session_id, filename):
+    """PNG thumbnail of the first page (or ?page=N) of an uploaded PDF"""
+    if not renderer_available():
+        return jsonify({'status': 'error', 'message': 'Thumbnails are not available on this server'}), 404
+    
+    manifest = session_store.get(session_id) or {}
+    file_info = next((f for f in manifest.get('files', []) if f['name'] == filename), None)
+    if file_info is None or not file_info.get('sha256'):
+        return jsonify({'status': 'error', 'message': 'File not found'}), 404
+    page = request.args.get('page', 1, type=int)
+    if not 1 <= page <= file_info['pages']:
+        return jsonify({'status': 'error', 'message': f"Page must be between 1 and {file_info['pages']}"}), 400
+    
+    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(session_id),
+                            secure_filename(filename))
+    thumbnail_path = thumbnail_cache.get(pdf_path, file_info['sha256'], page - 1)
+    if thumbnail_path is None:
+        return jsonify({'status': 'error', 'message': 'Could not render page'}), 422
+    # Content-addressed, so browsers can keep it
+    return send_file(os.path.abspath(thumbnail_path), mimetype='image/png', max_age=86400)
 
 @app.route('/reorder', methods=['POST'])
 def reorder_files():
@@ -177,10 +393,11 @@ def reorder_files():
         data = request.get_json()
         new_order = data.get('order', [])
         
-        if 'uploaded_files' not in session:
+        manifest = get_manifest()
+        if not manifest:
             return jsonify({'status': 'error', 'message': 'No files in session'})
         
-        files = session['uploaded_files']
+        files = manifest['files']
         reordered_files = []
         
         # Reorder files based on the new order
@@ -191,95 +408,114 @@ def reorder_files():
                     break
         
         # Update session with new order
-        session['uploaded_files'] = reordered_files
-        print(f"DEBUG: Reordered files: {[f['name'] for f in reordered_files]}")
+        manifest['files'] = reordered_files
+        manifest['merge_order'] = 'custom'
+        save_manifest(session['upload_id'], manifest)
+        log.debug('Reordered files: %s', [f['name'] for f in reordered_files])
         
         return jsonify({'status': 'success', 'message': 'Files reordered'})
         
     except Exception as e:
-        print(f"DEBUG: Reorder failed: {str(e)}")
+        log.warning('Reorder failed: %s', e)
         return jsonify({'status': 'error', 'message': str(e)})
 
 @app.route('/process', methods=['POST'])
 def process_merge():
     """Process PDF merge request"""
     try:
-        print("DEBUG: Starting merge process")
-        if 'uploaded_files' not in session:
+        log.debug('Starting merge process')
+        manifest = get_manifest()
+        if not manifest or not manifest.get('files'):
             flash('No files to merge', 'error')
             return redirect(url_for('index'))
         
-        files = session['uploaded_files']
-        print(f"DEBUG: Merging {len(files)} files")
-        output_filename = request.form.get('output_filename', 'merged_document.pdf')
-        
-        # Ensure output filename ends with .pdf
-        if not output_filename.endswith('.pdf'):
-            output_filename += '.pdf'
-        
-        print(f"DEBUG: Output filename: {output_filename}")
-        
-        # Create PDF writer
-        writer = PdfWriter()
-        total_pages = 0
-        
-        # Merge PDFs with error handling
-        for file_info in files:
-            print(f"DEBUG: Processing file: {file_info['name']}")
-            try:
-                reader = PdfReader(file_info['path'], strict=False)
-                
-                # Validate PDF has pages
-                if len(reader.pages) == 0:
-                    print(f"DEBUG: Skipping empty PDF: {file_info['name']}")
-                    continue
-                
-                # Add all pages
-                for page in reader.pages:
-                    writer.add_page(page)
-                    total_pages += 1
-                    
-            except Exception as e:
-                print(f"DEBUG: Error processing {file_info['name']}: {str(e)}")
-                flash(f'Error processing {file_info["name"]}: {str(e)}', 'warning')
-                continue
+        files = manifest['files']
+        log.debug('Merging %s files', len(files))
+        # A plain file name inside OUTPUT_FOLDER, ending in .pdf
+        output_filename = output_name(request.form.get('output_filename'), 'merged_document.pdf')
         
-        # Check if any pages were added
-        if total_pages == 0:
-            flash('No valid pages found to merge', 'error')
-            return redirect(url_for('merge'))
+        log.debug('Output filename: %s', output_filename)
         
-        # Save merged PDF
         output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        print(f"DEBUG: Saving to: {output_path}")
-        with open(output_path, 'wb') as output_file:
-            writer.write(output_file)
-        
-        print(f"DEBUG: Merge complete. Total pages: {total_pages}")
+        log.debug('Saving to: %s', output_path)
+        options = {
+            'dedupe': request.form.get('dedupe') == 'on',
+            'linearize': request.form.get('linearize') == 'on',
+            'profile': request.form.get('profile', 'none')
+        }
+        if options['profile'] not in COMPRESSION_PROFILES:
+            flash(f"Unknown output profile: {options['profile']}", 'error')
+            return redirect(url_for('merge'))
+        file_infos = get_pdf_infos([(f['path'], f.get('sha256')) for f in files])
+        cache_key = merge_cache_key(file_infos, options)
+        result = merge_result_cache.get(cache_key, output_path) if cache_key else None
+        if result is not None:
+            log.debug('Merge served from cache: %s', cache_key)
+            metrics.record_merge('cached')
+        else:
+            try:
+                ticket = admit_merge(file_infos, sum(info['pages'] for info in file_infos))
+            except Rejected as e:
+                # The merge page again, with the status and Retry-After of the API
+                flash(str(e), 'error')
+                response = make_response(merge())
+                response.status_code = e.status
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+            keep_path = merge_result_cache.staging_path(cache_key) if cache_key else None
+            try:
+                # On a merge worker process, so the merge gets its own core
+                result = merge_queue.run_merge([file_info['path'] for file_info in files],
+                                               output_path, dict(options, keep_path=keep_path))
+            except (MergeError, QueueFull) as e:
+                metrics.record_merge('sync', status='failed')
+                flash(str(e), 'error')
+                return redirect(url_for('merge'))
+            finally:
+                ticket.release()
+            metrics.record_merge('sync', pages=result['pages'], size=result['size_after'],
+                                 timings=result['timings'], errors=len(result['errors']))
+            if keep_path is not None:
+                try:
+                    if not result['errors']:
+                        merge_result_cache.put(cache_key, keep_path, result)
+                except OSError as e:
+                    log.warning('Could not cache merge result %s: %s', cache_key, e)
+                finally:
+                    merge_result_cache.discard(keep_path)
+        schedule_output(output_path)
+
+        for error in result['errors']:
+            flash(f'Error processing {error["name"]}: {error["message"]}', 'warning')
+        if options['linearize'] and not result.get('linearized'):
+            flash('Fast web view is not available on this server; saved a regular PDF', 'warning')
+
+        total_pages = result['pages']
+        log.debug('Merge complete. Total pages: %s', total_pages)
         
         # Store in session for download
-        session['merged_file'] = {
+        manifest['merged_file'] = {
             'filename': output_filename,
             'path': output_path,
             'pages': total_pages,
-            'size': f"{os.path.getsize(output_path) / 1024:.1f} KB"
+            'size': f"{os.path.getsize(output_path) / 1024:.1f} KB",
+            'bytes_saved': result['bytes_saved'],
+            'linearized': result.get('linearized', False),
+            'profile': options['profile'],
+            'size_before': result.get('size_before'),
+            'seconds': result.get('seconds')
         }
+        save_manifest(session['upload_id'], manifest)
         
         # Add to merge history
-        merge_history.append({
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'filename': output_filename,
-            'files_count': len(files),
-            'total_pages': total_pages
-        })
+        merge_history.record(output_filename, [f['name'] for f in files],
+                             pages=total_pages, size=os.path.getsize(output_path))
         
         flash('PDFs merged successfully!', 'success')
         return redirect(url_for('download', filename=output_filename))
         
     except Exception as e:
-        print(f"DEBUG: Merge failed with error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception('Merge failed with error: %s', e)
         flash(f'Merge failed: {str(e)}', 'error')
         return redirect(url_for('merge'))
 
@@ -289,10 +525,11 @@ def debug_session():
     debug_info = {
         'session_keys': list(session.keys()),
         'upload_id': session.get('upload_id'),
-        'uploaded_files_count': len(session.get('uploaded_files', [])),
-        'merged_file': session.get('merged_file'),
+        'session_store': app.config['SESSION_STORE'],
+        'manifest': get_manifest(),
         'uploads_dir_exists': os.path.exists(app.config['UPLOAD_FOLDER']),
-        'output_dir_exists': os.path.exists(app.config['OUTPUT_FOLDER'])
+        'output_dir_exists': os.path.exists(app.config['OUTPUT_FOLDER']),
+        'cleanup': dict(cleanup_service.totals, pending=expiry_index.pending())
     }
     
     # Check for existing session folders
@@ -320,22 +557,15 @@ def recover_session(session_id):
         flash('Session not found', 'error')
         return redirect(url_for('index'))
     
-    # Rebuild session
-    uploaded_files = []
-    for filename in os.listdir(session_folder):
-        if filename.endswith('.pdf'):
-            filepath = os.path.join(session_folder, filename)
-            pdf_info = get_pdf_info(filepath)
-            uploaded_files.append({
-                'name': filename,
-                'path': filepath,
-                'pages': pdf_info['pages'],
-                'size': f"{pdf_info['size'] / 1024:.1f} KB"
-            })
+    # The stored manifest keeps the merge order; rescan only if it is gone
+    manifest = get_manifest(session_id)
+    if not manifest or not manifest.get('files'):
+        manifest = {'files': scan_session_folder(session_folder), 'merge_order': 'filename'}
+    uploaded_files = manifest['files']
     
     if uploaded_files:
         session['upload_id'] = session_id
-        session['uploaded_files'] = uploaded_files
+        save_manifest(session_id, manifest)
         flash(f'Recovered session with {len(uploaded_files)} files', 'success')
         return redirect(url_for('merge'))
     else:
@@ -345,74 +575,156 @@ def recover_session(session_id):
 @app.route('/download/<filename>')
 def download(filename):
     """Download merged PDF"""
-    print(f"DEBUG: Download page requested for: {filename}")
-    print(f"DEBUG: Session has merged_file: {'merged_file' in session}")
+    log.debug('Download page requested for: %s', filename)
+    manifest = get_manifest() or {}
     
-    if 'merged_file' in session:
-        print(f"DEBUG: Session merged_file: {session['merged_file']}")
-        if session['merged_file']['filename'] == filename:
-            file_info = session['merged_file']
-            print(f"DEBUG: Rendering download page with file info: {file_info}")
+    if 'merged_file' in manifest:
+        log.debug('Session merged_file: %s', manifest['merged_file'])
+        if manifest['merged_file']['filename'] == filename:
+            file_info = manifest['merged_file']
+            log.debug('Rendering download page with file info: %s', file_info)
             return render_template('simple_download.html', 
                                  filename=filename,
                                  pages=file_info['pages'],
-                                 size=file_info['size'])
+                                 size=file_info['size'],
+                                 bytes_saved=file_info.get('bytes_saved', 0),
+                                 linearized=file_info.get('linearized', False),
+                                 profile=file_info.get('profile', 'none'),
+                                 size_before=file_info.get('size_before'),
+                                 seconds=file_info.get('seconds'))
     
-    print(f"DEBUG: Rendering download page without file info")
+    log.debug('Rendering download page without file info')
     return render_template('simple_download.html', filename=filename, pages='Unknown', size='Unknown')
 
 @app.route('/download_file/<filename>')
 def download_file(filename):
     """Actual file download"""
     file_path = os.path.abspath(os.path.join(app.config['OUTPUT_FOLDER'], filename))
-    print(f"DEBUG: Download requested: {filename}")
-    print(f"DEBUG: File path: {file_path}")
-    print(f"DEBUG: File exists: {os.path.exists(file_path)}")
+    log.debug('Download requested: %s', file_path)
     
     if os.path.exists(file_path):
         try:
-            return send_file(file_path, as_attachment=True, download_name=filename)
-        except Exception as e:
-            print(f"DEBUG: Send file error: {e}")
+            with stage('send_file'):
+                response = send_output_file(filename, inline=request.args.get('inline') == '1')
+            # Bytes in this response (a range or nothing for a 304); 0 when offloaded
+            if 'X-Sendfile' not in response.headers and 'X-Accel-Redirect' not in response.headers:
+                metrics.BYTES.inc(response.content_length or 0, direction='downloaded')
+            return response
+        except OSError as e:
+            log.warning('Send file error: %s', e)
             return f"Download error: {e}", 500
     else:
         return f"File not found: {filename}", 404
 
+def send_output_file(filename, inline=False):
+    """Response for a file in OUTPUT_FOLDER
 
+    Served directly, this supports Range/If-Range, ETag/Last-Modified and
+    304s. With DOWNLOAD_OFFLOAD set, only headers are produced and the
+    front proxy sends the bytes (and handles ranges and conditionals).
+    """
+    offload = app.config['DOWNLOAD_OFFLOAD']
+    response = send_from_directory(
+        os.path.abspath(app.config['OUTPUT_FOLDER']), filename, request.environ,
+        mimetype='application/pdf',
+        as_attachment=not inline,
+        download_name=filename,
+        conditional=offload is None,
+        etag=True,
+        max_age=app.config['DOWNLOAD_MAX_AGE'],
+        use_x_sendfile=offload is not None,
+        response_class=app.response_class)
+    if offload is None:
+        # Advertise ranges on full responses too, PDF viewers look for it
+        response.headers.setdefault('Accept-Ranges', 'bytes')
+    elif offload == 'x-accel-redirect':
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = app.config['DOWNLOAD_ACCEL_PREFIX'] + quote(filename)
+    return response
+
+
+
+def parse_history_query(args):
+    """Keyword arguments for merge_history.page() from request args
+
+    since/until are dates (YYYY-MM-DD, both inclusive), filename is a
+    prefix of the output file name. Raises ValueError on bad input.
+    """
+    query = {
+        'cursor': int(args['cursor']) if args.get('cursor') else None,
+        'limit': min(int(args.get('limit', app.config['HISTORY_PAGE_SIZE'])),
+                     app.config['HISTORY_MAX_PAGE_SIZE']),
+        'filename': args.get('filename', '').strip() or None
+    }
+    if query['limit'] < 1:
+        raise ValueError('limit must be positive')
+    if args.get('since'):
+        query['since'] = datetime.strptime(args['since'], '%Y-%m-%d').timestamp()
+    if args.get('until'):
+        until = datetime.strptime(args['until'], '%Y-%m-%d') + timedelta(days=1)
+        query['until'] = until.timestamp()
+    return query
 
 @app.route('/history')
 def history():
-    """Show merge history"""
-    return render_template('history.html', history=merge_history[::-1])  # Reverse for newest first
+    """Show merge history, newest first, one page at a time"""
+    try:
+        query = parse_history_query(request.args)
+    except ValueError:
+        flash('Invalid history filter', 'error')
+        return redirect(url_for('history'))
+    items, next_cursor = merge_history.page(**query)
+    filters = {key: request.args[key] for key in ('since', 'until', 'filename') if request.args.get(key)}
+    return render_template('history.html', history=items, next_cursor=next_cursor,
+                           filters=filters, paged='cursor' in request.args)
 
 @app.route('/api/upload', methods=['POST'])
 def api_upload():
     """API endpoint for file upload"""
     try:
-        files = request.files.getlist('files')
+        # Parsing the body is what streams the file parts to disk
+        with stage('upload_save'):
+            files = request.files.getlist('files')
         if not files:
             return jsonify({'status': 'error', 'message': 'No files provided'})
         
         session_id = str(uuid.uuid4())
         session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
         os.makedirs(session_folder, exist_ok=True)
+        expiry_index.schedule(session_folder, app.config['UPLOAD_TTL'], kind='upload')
         
-        uploaded_files = []
+        saved = []
         for file in files:
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 filepath = os.path.join(session_folder, filename)
-                file.save(filepath)
-                
-                pdf_info = get_pdf_info(filepath)
-                if pdf_info['pages'] > 0:
-                    uploaded_files.append({
-                        'name': filename,
-                        'pages': pdf_info['pages'],
-                        'size': pdf_info['size']
-                    })
-                else:
-                    os.remove(filepath)  # Remove corrupted file
+                try:
+                    ingest_info = save_upload(file, filepath)
+                except UploadRejected:
+                    metrics.STAGE_ERRORS.inc(stage='upload_save')
+                    continue
+                metrics.BYTES.inc(ingest_info['size'], direction='uploaded')
+                saved.append((filename, filepath, ingest_info.get('sha256')))
+        
+        pdf_infos = get_pdf_infos([(filepath, sha256) for _, filepath, sha256 in saved])
+        uploaded_files = []
+        for (filename, filepath, _), pdf_info in zip(saved, pdf_infos):
+            if pdf_info['pages'] > 0:
+                uploaded_files.append({
+                    'name': filename,
+                    'pages': pdf_info['pages'],
+                    'size': pdf_info['size'],
+                    'sha256': pdf_info['sha256']
+                })
+            else:
+                os.remove(filepath)  # Remove corrupted file
+        
+        save_manifest(session_id, {
+            'files': [dict(f, path=os.path.join(session_folder, f['name'])) for f in uploaded_files],
+            'merge_order': 'filename'
+        })
+        thumbnail_cache.prewarm([(os.path.join(session_folder, f['name']), f['sha256'], 0)
+                                 for f in uploaded_files])
         
         return jsonify({
             'status': 'success',
@@ -420,65 +732,662 @@ def api_upload():
             'files': uploaded_files
         })
         
+    except RequestEntityTooLarge:
+        max_mb = app.config['MAX_FILE_SIZE'] // (1024 * 1024)
+        return jsonify({'status': 'error', 'message': f'File too large. Maximum size is {max_mb}MB per file.'}), 413
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/api/upload/chunked', methods=['POST'])
+def api_chunked_start():
+    """Start a resumable upload of one file, in a new or an existing API session"""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+    if not filename or not allowed_file(filename):
+        return jsonify({'status': 'error', 'message': 'A .pdf filename is required'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'status': 'error', 'message': 'size must be a positive number of bytes'}), 400
+    if size > app.config['MAX_CHUNKED_FILE_SIZE']:
+        max_mb = app.config['MAX_CHUNKED_FILE_SIZE'] // (1024 * 1024)
+        return jsonify({'status': 'error', 'message': f'File too large. Maximum size is {max_mb}MB.'}), 413
+    
+    session_id = data.get('session_id')
+    if session_id:
+        session_id = secure_filename(session_id)
+        if not os.path.isdir(os.path.join(app.config['UPLOAD_FOLDER'], session_id)):
+            return jsonify({'status': 'error', 'message': 'Session not found'}), 404
+    else:
+        session_id = str(uuid.uuid4())
+        os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], session_id), exist_ok=True)
+        save_manifest(session_id, {'files': [], 'merge_order': 'filename'})
+    
+    state = chunked_uploads.create(session_id, filename, size)
+    # Every chunk rewrites both files, which pushes their expiry back
+    for path in (chunked_uploads.part_path(state['upload_id']),
+                 chunked_uploads.state_path(state['upload_id'])):
+        expiry_index.schedule(path, app.config['UPLOAD_TTL'], kind='chunked')
+    return jsonify({
+        'status': 'success',
+        'upload_id': state['upload_id'],
+        'session_id': session_id,
+        'chunk_size': min(app.config['UPLOAD_CHUNK_SIZE'], app.config['MAX_FILE_SIZE']),
+        'upload_url': url_for('api_chunked_upload', upload_id=state['upload_id'])
+    }), 201
+
+def chunked_state_json(state):
+    return {'status': 'success', 'upload_id': state['upload_id'],
+            'session_id': state['session_id'], 'filename': state['filename'],
+            'size': state['size'], 'received': state['received'],
+            'complete': state['received'] == state['size']}
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['GET', 'PUT'])
+def api_chunked_upload(upload_id):
+    """GET what has been received so far; PUT the next chunk at ?offset=<received>
+
+    The chunk is the raw request body; its SHA-256 (hex) goes in the
+    X-Chunk-SHA256 header.
+    """
+    if request.method == 'GET':
+        state = chunked_uploads.get(upload_id)
+        if state is None:
+            return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
+        return jsonify(chunked_state_json(state))
+    
+    offset = request.args.get('offset', type=int)
+    checksum = request.headers.get('X-Chunk-SHA256')
+    if offset is None or not checksum:
+        return jsonify({'status': 'error',
+                        'message': 'offset and the X-Chunk-SHA256 header are required'}), 400
+    try:
+        with stage('upload_save'):
+            state, stored = chunked_uploads.write_chunk(upload_id, offset, request.stream, checksum,
+                                                        max_chunk=app.config['MAX_FILE_SIZE'])
+    except ChunkRejected as e:
+        body = {'status': 'error', 'message': str(e)}
+        current = chunked_uploads.get(upload_id)
+        if current is not None:
+            body['received'] = current['received']
+        return jsonify(body), e.status
+    if stored:
+        metrics.BYTES.inc(stored, direction='uploaded')
+    # The session must outlive a long upload into it
+    touch_session(state['session_id'])
+    return jsonify(chunked_state_json(state))
+
+@app.route('/api/upload/chunked/<upload_id>/complete', methods=['POST'])
+def api_chunked_complete(upload_id):
+    """Finish a chunked upload; the file joins its session like a normal upload"""
+    data = request.get_json(silent=True) or {}
+    state = chunked_uploads.get(upload_id)
+    if state is None:
+        return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
+    session_id = state['session_id']
+    session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    filepath = os.path.join(session_folder, state['filename'])
+    try:
+        ingest_info = chunked_uploads.finalize(upload_id, filepath, sha256=data.get('sha256'))
+    except ChunkRejected as e:
+        return jsonify({'status': 'error', 'message': str(e)}), e.status
+    except UploadRejected as e:
+        return jsonify({'status': 'error', 'message': f'Not a valid PDF: {str(e)}'}), 422
+    except OSError as e:
+        if not os.path.isdir(session_folder):
+            # Swept while the upload was idle; the file has nowhere to go
+            chunked_uploads.discard(upload_id)
+            return jsonify({'status': 'error', 'message': 'Session expired'}), 410
+        log.warning('Could not finalize chunked upload %s: %s', upload_id, e)
+        return jsonify({'status': 'error', 'message': f'Could not store the file: {e}'}), 409
+    
+    pdf_info = get_pdf_infos([(filepath, ingest_info['sha256'])])[0]
+    if pdf_info['pages'] == 0:
+        os.remove(filepath)
+        return jsonify({'status': 'error', 'message': 'Not a valid PDF: no pages found'}), 422
+    file_info = {
+        'name': state['filename'],
+        'pages': pdf_info['pages'],
+        'size': pdf_info['size'],
+        'sha256': pdf_info['sha256']
+    }
+    manifest = session_store.get(session_id) or {'files': [], 'merge_order': 'filename'}
+    manifest['files'] = [f for f in manifest.get('files', []) if f['name'] != file_info['name']]
+    manifest['files'].append(dict(file_info, path=filepath))
+    save_manifest(session_id, manifest)
+    thumbnail_cache.prewarm([(filepath, file_info['sha256'], 0)])
+    
+    return jsonify({'status': 'success', 'session_id': session_id, 'file': file_info})
+
+def session_file_infos(session_id):
+    """(session folder, file infos sorted by name) of an API upload session
+
+    The stored manifest already has hashes and page counts, so nothing is
+    re-read; without one the folder is scanned. Returns (None, None) for
+    an unknown session.
+    """
+    session_folder = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(session_id))
+    if not os.path.exists(session_folder):
+        return None, None
+    manifest = session_store.get(session_id)
+    if manifest and manifest.get('files'):
+        return session_folder, sorted(manifest['files'], key=lambda x: x['name'])
+    pdf_files = sorted(f for f in os.listdir(session_folder) if f.endswith('.pdf'))
+    paths = [os.path.join(session_folder, filename) for filename in pdf_files]
+    file_infos = [dict(info, name=filename) for filename, info in
+                  zip(pdf_files, get_pdf_infos([(path, None) for path in paths]))]
+    return session_folder, file_infos
+
+def build_merge_specs(session_folder, file_infos, selection=None):
+    """MergeSpecs, their file infos and the output page count for a merge
+
+    selection is the "files" list of a request: {"name", "pages", "rotate"}
+    dicts in merge order. Without it every file is merged whole, in name
+    order. Raises ValueError for unknown files, page ranges or rotations.
+    """
+    if selection is None:
+        specs = [MergeSpec(os.path.join(session_folder, info['name'])) for info in file_infos]
+        return specs, file_infos, sum(info['pages'] for info in file_infos)
+    
+    infos_by_name = {info['name']: info for info in file_infos}
+    specs = []
+    selected_infos = []
+    total_pages = 0
+    for item in selection:
+        if isinstance(item, str):
+            item = {'name': item}
+        info = infos_by_name.get(item.get('name'))
+        if info is None:
+            raise ValueError(f"Unknown file: {item.get('name')}")
+        spec = MergeSpec(os.path.join(session_folder, info['name']),
+                         pages=item.get('pages') or None, rotate=item.get('rotate', 0))
+        # Checks the ranges against the stored page count before queueing
+        total_pages += len(spec.page_indices(info['pages']))
+        specs.append(spec)
+        selected_infos.append(info)
+    return specs, selected_infos, total_pages
+
+def spec_cache_key(specs, file_infos, options):
+    """Result cache key of a merge of specs, including any page selection"""
+    key_options = dict(options)
+    if any(spec.pages or spec.rotate for spec in specs):
+        key_options['selection'] = [[spec.pages, spec.rotate] for spec in specs]
+    return merge_cache_key(file_infos, key_options)
+
+def output_name(filename, default='merged.pdf'):
+    """Safe output file name ending in .pdf"""
+    filename = secure_filename(filename or '') or default
+    if not filename.endswith('.pdf'):
+        filename += '.pdf'
+    return filename
+
+def client_id():
+    """Who a merge is charged to: the CLIENT_ID_HEADER value if configured, else the remote address"""
+    header = app.config['CLIENT_ID_HEADER']
+    value = request.headers.get(header) if header else None
+    # In X-Forwarded-For style lists only the last entry, appended by the
+    # proxy, can be trusted; the client chooses everything before it
+    return value.split(',')[-1].strip() if value else (request.remote_addr or 'unknown')
+
+def admit_merge(file_infos, total_pages, outputs=1):
+    """Admission ticket for a merge by the current client; raises Rejected
+
+    A batch passes the inputs and pages of all its outputs, and takes a
+    slot of the in-flight cap per output.
+    """
+    cost = merge_cost(total_pages, sum(info.get('size') or 0 for info in file_infos))
+    try:
+        return admission.admit(client_id(), cost, slots=outputs)
+    except Rejected as e:
+        metrics.ADMISSION_REJECTED.inc(reason='rate_limit' if e.status == 429 else 'capacity')
+        log.info('Rejected merge of cost %.0f by %s: %s', cost, client_id(), e)
+        raise
+
+def rejected_response(error):
+    response = jsonify({'status': 'error', 'message': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status
+
+def start_merge(specs, file_infos, total_pages, output_filename, options, stream=False):
+    """Response for a merge request: streamed, served from cache, or queued"""
+    if options.get('profile', 'none') not in COMPRESSION_PROFILES:
+        return jsonify({'status': 'error', 'message': f"Unknown output profile: {options['profile']}. "
+                        f"Use one of {', '.join(COMPRESSION_PROFILES)}"}), 400
+    output_filename = output_name(output_filename)
+    
+    if stream:
+        try:
+            ticket = admit_merge(file_infos, total_pages)
+        except Rejected as e:
+            return rejected_response(e)
+        try:
+            response = make_response(stream_merge(specs, output_filename, options))
+        except Exception:
+            ticket.release()
+            raise
+        # Once the body has been sent, or the client has gone away
+        response.call_on_close(ticket.release)
+        return response
+    
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    download_url = f'/download_file/{output_filename}'
+    
+    # Identical inputs, pages and options were merged before: reuse that output
+    cache_key = spec_cache_key(specs, file_infos, options)
+    cached = merge_result_cache.get(cache_key, output_path) if cache_key else None
+    if cached is not None:
+        task_id = merge_queue.record_completed(output_path, download_url, cached, sources=specs)
+        schedule_output(output_path, task_id)
+        return jsonify({
+            'status': 'completed',
+            'task_id': task_id,
+            'status_url': url_for('api_status', task_id=task_id),
+            'download_url': download_url,
+            'filename': output_filename,
+            'cached': True
+        })
+    
+    # Hand the merge off to the worker pool
+    try:
+        ticket = admit_merge(file_infos, total_pages)
+    except Rejected as e:
+        return rejected_response(e)
+    try:
+        task_id = merge_queue.submit_merge(specs, output_path, download_url,
+                                           total_pages=total_pages, options=options,
+                                           cache=merge_result_cache, cache_key=cache_key,
+                                           done=ticket.release)
+    except QueueFull as e:
+        ticket.release()
+        response = jsonify({'status': 'error', 'message': str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except Exception:
+        # Nothing was queued, so done will never release it
+        ticket.release()
+        raise
+    # Scheduled now; the sweep postpones it if the job writes the file later
+    schedule_output(output_path, task_id)
+    
+    return jsonify({
+        'status': 'queued',
+        'task_id': task_id,
+        'status_url': url_for('api_status', task_id=task_id),
+        'filename': output_filename
+    }), 202
+
 @app.route('/api/merge', methods=['POST'])
 def api_merge():
     """API endpoint for PDF merge"""
     try:
         data = request.get_json()
         session_id = data.get('session_id')
-        output_filename = data.get('output_filename', 'merged.pdf')
+        options = {
+            'dedupe': bool(data.get('dedupe', False)),
+            'linearize': bool(data.get('linearize', False)),
+            'interleave': bool(data.get('interleave', False)),
+            'profile': data.get('profile', 'none')
+        }
         
         if not session_id:
             return jsonify({'status': 'error', 'message': 'No session ID provided'})
         
-        session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
-        if not os.path.exists(session_folder):
+        session_folder, file_infos = session_file_infos(session_id)
+        if session_folder is None:
             return jsonify({'status': 'error', 'message': 'Session not found'})
         
-        # Get all PDF files in session folder
-        pdf_files = [f for f in os.listdir(session_folder) if f.endswith('.pdf')]
-        pdf_files.sort()
+        try:
+            specs, file_infos, total_pages = build_merge_specs(session_folder, file_infos,
+                                                               data.get('files'))
+        except (ValueError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         
-        # Merge PDFs with error handling
-        writer = PdfWriter()
-        for filename in pdf_files:
-            filepath = os.path.join(session_folder, filename)
-            try:
-                reader = PdfReader(filepath, strict=False)
-                for page in reader.pages:
-                    writer.add_page(page)
-            except Exception as e:
-                print(f"DEBUG: API merge error for {filename}: {str(e)}")
+        return start_merge(specs, file_infos, total_pages,
+                           data.get('output_filename', 'merged.pdf'), options,
+                           stream=data.get('stream'))
+        
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route('/api/batch_merge', methods=['POST'])
+def api_batch_merge():
+    """API endpoint for many independent merges in one request
+
+    Takes {"outputs": [{"output_filename", "inputs": [{"session_id",
+    "name", "pages", "rotate"}, ...]}, ...]} plus the merge options, which
+    apply to every output. Inputs may come from any API upload session.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'status': 'error', 'message': 'Expected a JSON object'}), 400
+        options = {
+            'dedupe': bool(data.get('dedupe', False)),
+            'linearize': bool(data.get('linearize', False)),
+            'interleave': bool(data.get('interleave', False)),
+            'profile': data.get('profile', 'none')
+        }
+        outputs = data.get('outputs')
+        if not isinstance(outputs, list) or not outputs:
+            return jsonify({'status': 'error', 'message': 'outputs must be a non-empty list'}), 400
+        if len(outputs) > app.config['BATCH_MAX_OUTPUTS']:
+            return jsonify({'status': 'error', 'message': f"At most {app.config['BATCH_MAX_OUTPUTS']} "
+                            f"outputs per batch"}), 400
+        if not isinstance(options['profile'], str) or options['profile'] not in COMPRESSION_PROFILES:
+            return jsonify({'status': 'error', 'message': f"Unknown output profile: {options['profile']}. "
+                            f"Use one of {', '.join(COMPRESSION_PROFILES)}"}), 400
+        
+        # Validate everything before anything is queued; each session is read once
+        sessions = {}
+        planned = []
+        for i, item in enumerate(outputs):
+            if not isinstance(item, dict):
+                return jsonify({'status': 'error', 'message': f"outputs[{i}] must be an object"}), 400
+            if not isinstance(item.get('output_filename') or '', str):
+                return jsonify({'status': 'error',
+                                'message': f"outputs[{i}]: output_filename must be a string"}), 400
+            output_filename = output_name(item.get('output_filename'), f'batch_{i + 1}.pdf')
+            if any(p['filename'] == output_filename for p in planned):
+                return jsonify({'status': 'error',
+                                'message': f"Duplicate output_filename: {output_filename}"}), 400
+            inputs = item.get('inputs')
+            if not isinstance(inputs, list) or not inputs:
+                return jsonify({'status': 'error',
+                                'message': f"{output_filename}: inputs must be a non-empty list"}), 400
+            specs, file_infos, total_pages = [], [], 0
+            for selection in inputs:
+                if not (isinstance(selection, dict) and isinstance(selection.get('session_id'), str)
+                        and isinstance(selection.get('name'), str)):
+                    return jsonify({'status': 'error', 'message': f"{output_filename}: every input "
+                                    f"must be an object with session_id and name strings"}), 400
+                session_id = selection['session_id']
+                if session_id not in sessions:
+                    sessions[session_id] = session_file_infos(session_id) if session_id else (None, None)
+                session_folder, session_infos = sessions[session_id]
+                if session_folder is None:
+                    return jsonify({'status': 'error',
+                                    'message': f"{output_filename}: session not found: {session_id}"}), 400
+                try:
+                    more_specs, more_infos, more_pages = build_merge_specs(session_folder, session_infos,
+                                                                           [selection])
+                except (ValueError, TypeError) as e:
+                    return jsonify({'status': 'error', 'message': f"{output_filename}: {str(e)}"}), 400
+                specs += more_specs
+                file_infos += more_infos
+                total_pages += more_pages
+            planned.append({'filename': output_filename, 'specs': specs, 'file_infos': file_infos,
+                            'total_pages': total_pages})
+        
+        results = []
+        queued = []
+        for plan in planned:
+            output_path = os.path.join(app.config['OUTPUT_FOLDER'], plan['filename'])
+            download_url = f"/download_file/{plan['filename']}"
+            cache_key = spec_cache_key(plan['specs'], plan['file_infos'], options)
+            cached = merge_result_cache.get(cache_key, output_path) if cache_key else None
+            if cached is not None:
+                task_id = merge_queue.record_completed(output_path, download_url, cached,
+                                                       sources=plan['specs'])
+                schedule_output(output_path, task_id)
+                results.append({'output_filename': plan['filename'], 'task_id': task_id, 'cached': True})
+                plan['cached'] = True
                 continue
+            plan['cached'] = False
+            queued.append({'sources': plan['specs'], 'output_path': output_path,
+                           'download_url': download_url, 'total_pages': plan['total_pages'],
+                           'cache_key': cache_key})
+            results.append({'output_filename': plan['filename'], 'cached': False})
         
-        # Save merged PDF
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        with open(output_path, 'wb') as output_file:
-            writer.write(output_file)
+        if queued:
+            try:
+                ticket = admit_merge([info for plan in planned if not plan['cached']
+                                      for info in plan['file_infos']],
+                                     sum(plan['total_pages'] for plan in planned if not plan['cached']),
+                                     outputs=len(queued))
+            except Rejected as e:
+                return rejected_response(e)
+            try:
+                task_ids = iter(merge_queue.submit_batch(queued, options, cache=merge_result_cache,
+                                                         done=ticket.release))
+            except QueueFull as e:
+                ticket.release()
+                response = jsonify({'status': 'error', 'message': str(e)})
+                response.headers['Retry-After'] = '5'
+                return response, 503
+            except Exception:
+                # done may never run; releasing twice is harmless
+                ticket.release()
+                raise
+            for result in results:
+                if not result['cached']:
+                    result['task_id'] = next(task_ids)
+                    schedule_output(os.path.join(app.config['OUTPUT_FOLDER'], result['output_filename']),
+                                    result['task_id'])
+        for result in results:
+            result['status_url'] = url_for('api_status', task_id=result['task_id'])
         
+        batch_id = str(uuid.uuid4())
+        write_batch(batch_id, results, archive=bool(data.get('archive', False)))
         return jsonify({
-            'status': 'success',
-            'download_url': f'/download_file/{output_filename}',
-            'filename': output_filename
-        })
+            'status': 'queued' if queued else 'completed',
+            'batch_id': batch_id,
+            'status_url': url_for('api_batch_status', batch_id=batch_id),
+            'outputs': results
+        }), 202 if queued else 200
+        
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+
+def write_batch(batch_id, outputs, archive=False):
+    """Record which jobs make up a batch, next to their status files"""
+    write_status(app.config['JOBS_FOLDER'], batch_id, kind='batch', archive=archive,
+                 outputs=[{'output_filename': o['output_filename'], 'task_id': o['task_id']}
+                          for o in outputs])
+    expiry_index.schedule(os.path.join(app.config['JOBS_FOLDER'], f"{batch_id}.json"),
+                          app.config['OUTPUT_TTL'], kind='job')
+
+def batch_state(batch_id):
+    """(batch record, per-output statuses) of a batch, or (None, None)"""
+    batch = merge_queue.status(batch_id)
+    if batch is None or batch.get('kind') != 'batch':
+        return None, None
+    outputs = []
+    for output in batch['outputs']:
+        status = merge_queue.status(output['task_id']) or {'status': 'failed', 'message': 'Job status expired'}
+        outputs.append(dict(status, output_filename=output['output_filename'],
+                            task_id=output['task_id']))
+    return batch, outputs
+
+@app.route('/api/batch/<batch_id>')
+def api_batch_status(batch_id):
+    """API endpoint with the status of every output of a batch merge"""
+    batch, outputs = batch_state(batch_id)
+    if batch is None:
+        return jsonify({'status': 'error', 'message': 'Batch not found'}), 404
+    completed = sum(1 for o in outputs if o['status'] == 'completed')
+    failed = sum(1 for o in outputs if o['status'] == 'failed')
+    if completed + failed < len(outputs):
+        status = 'running'
+    elif failed == 0:
+        status = 'completed'
+    else:
+        status = 'failed' if completed == 0 else 'partial'
+    body = {'status': status, 'batch_id': batch_id, 'total': len(outputs),
+            'completed': completed, 'failed': failed, 'outputs': outputs}
+    if batch.get('archive') and status in ('completed', 'partial'):
+        body['archive_url'] = url_for('api_batch_archive', batch_id=batch_id)
+    return jsonify(body)
+
+class _ArchiveBuffer:
+    """Write-only target that zipfile streams the archive into"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+def iter_archive(paths, chunk_size=1024 * 1024):
+    """Yield an uncompressed ZIP of paths as it is written (PDFs hardly compress)"""
+    buffer = _ArchiveBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for path in paths:
+            info = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+            with open(path, 'rb') as source, \
+                    archive.open(info, 'w', force_zip64=info.file_size > 0x7fffffff) as dest:
+                for data in iter(lambda: source.read(chunk_size), b''):
+                    dest.write(data)
+                    yield buffer.take()
+    yield buffer.take()
+
+@app.route('/api/batch/<batch_id>/archive')
+def api_batch_archive(batch_id):
+    """ZIP of the completed outputs of a finished batch, streamed as it is built"""
+    batch, outputs = batch_state(batch_id)
+    if batch is None:
+        return jsonify({'status': 'error', 'message': 'Batch not found'}), 404
+    if any(o['status'] not in ('completed', 'failed') for o in outputs):
+        return jsonify({'status': 'error', 'message': 'Batch is still running'}), 409
+    paths = [os.path.join(app.config['OUTPUT_FOLDER'], o['output_filename'])
+             for o in outputs if o['status'] == 'completed']
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return jsonify({'status': 'error', 'message': 'No outputs to archive'}), 404
+    response = Response(iter_archive(paths), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="batch-{batch_id}.zip"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/extract', methods=['POST'])
+def api_extract():
+    """API endpoint to extract (and rotate) pages of one uploaded PDF"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        filename = data.get('file')
+        options = {
+            'dedupe': bool(data.get('dedupe', False)),
+            'linearize': bool(data.get('linearize', False)),
+            'profile': data.get('profile', 'none')
+        }
+        
+        if not session_id or not filename:
+            return jsonify({'status': 'error', 'message': 'session_id and file are required'})
+        if not data.get('pages'):
+            return jsonify({'status': 'error', 'message': 'No pages selected'}), 400
+        
+        session_folder, file_infos = session_file_infos(session_id)
+        if session_folder is None:
+            return jsonify({'status': 'error', 'message': 'Session not found'})
+        
+        try:
+            specs, file_infos, total_pages = build_merge_specs(
+                session_folder, file_infos,
+                [{'name': filename, 'pages': data['pages'], 'rotate': data.get('rotate', 0)}])
+        except (ValueError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+        default_name = f"{os.path.splitext(filename)[0]}_pages.pdf"
+        return start_merge(specs, file_infos, total_pages,
+                           data.get('output_filename', default_name), options,
+                           stream=data.get('stream'))
         
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
+def stream_merge(sources, output_filename, options):
+    """Send a merge straight back as a chunked PDF response, without an output file
+
+    Errors before the first chunk get a normal JSON error. Later failures
+    can no longer change the status code; they end the body with a
+    "%MERGE-ERROR" comment line. Files that were skipped are listed as
+    "%MERGE-WARNING" comments after %%EOF.
+    """
+    if options.get('linearize'):
+        return jsonify({'status': 'error', 'message': 'Linearized output cannot be streamed'}), 400
+    
+    result = {}
+    chunks = iter_merge(sources, result, dedupe=options.get('dedupe', False),
+                        interleave=options.get('interleave', False),
+                        profile=options.get('profile', 'none'))
+    try:
+        first_chunk = next(chunks)
+    except MergeError as e:
+        metrics.record_merge('stream', status='failed')
+        return jsonify({'status': 'error', 'message': str(e)}), 422
+    
+    def generate():
+        yield first_chunk
+        size = len(first_chunk)
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        except Exception as e:
+            log.warning('Streamed merge failed: %s', e)
+            metrics.record_merge('stream', status='failed')
+            yield f"\n%MERGE-ERROR {str(e)}\n".encode('utf-8', 'replace')
+            return
+        metrics.record_merge('stream', pages=result['pages'], size=size,
+                             timings=result['timings'], errors=len(result['errors']))
+        for error in result['errors']:
+            yield f"%MERGE-WARNING {error['name']}: {error['message']}\n".encode('utf-8', 'replace')
+    
+    response = Response(generate(), mimetype='application/pdf')
+    response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(output_filename)}"'
+    response.headers['X-Accel-Buffering'] = 'no'  # let nginx pass chunks through
+    return response
+
+@app.route('/api/history')
+def api_history():
+    """API endpoint for merge history, paginated with next_cursor"""
+    try:
+        query = parse_history_query(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f'Invalid history query: {str(e)}'}), 400
+    items, next_cursor = merge_history.page(**query)
+    return jsonify({'status': 'success', 'items': items, 'next_cursor': next_cursor})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of this server process"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/load')
+def api_load():
+    """Current merge load of this server process, for load balancer checks
+
+    Answers 503 once the merges in flight or the merge queue reach
+    LOAD_SHED_THRESHOLD of their limits, so new work can go elsewhere
+    before requests start being rejected.
+    """
+    load = admission.load()
+    depth = merge_queue.depth()
+    queue_utilization = round(depth / merge_queue.max_depth, 3) if merge_queue.max_depth else 0.0
+    load.update(queue_depth=depth, max_queue_depth=merge_queue.max_depth,
+                queue_utilization=queue_utilization)
+    shedding = max(load['utilization'], queue_utilization) >= app.config['LOAD_SHED_THRESHOLD']
+    return jsonify(dict(load, status='overloaded' if shedding else 'ok')), 503 if shedding else 200
+
 @app.route('/api/status/<task_id>')
 def api_status(task_id):
     """API endpoint to check merge status"""
-    # Simple status check - in production, use proper task queue
-    return jsonify({'status': 'completed', 'progress': 100})
+    status = merge_queue.status(task_id)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'Task not found'}), 404
+    return jsonify(status)
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
     """Clear merge history"""
-    global merge_history
-    merge_history = []
+    merge_history.clear()
     flash('History cleared successfully!', 'success')
     return redirect(url_for('history'))
 
@@ -492,7 +1401,8 @@ def internal_error(error):
 
 @app.errorhandler(413)
 def too_large(error):
-    return render_template('error.html', error='File too large. Maximum size is 50MB.'), 413
+    max_mb = app.config['MAX_FILE_SIZE'] // (1024 * 1024)
+    return render_template('error.html', error=f'File too large. Maximum size is {max_mb}MB per file.'), 413
 
 @app.route('/recovery')
 def recovery_page():
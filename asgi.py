@@ -0,0 +1,202 @@
+"""
+ASGI serving mode
+Serves the existing Flask routes from an event loop, e.g.
+
+    pip install uvicorn
+    uvicorn asgi:app --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+Request bodies are received asynchronously and spooled to a temporary
+file before a route runs, so a slow upload only costs an idle coroutine.
+Routes then run on a thread pool against the complete body. Responses are
+sent chunk by chunk: each chunk is produced on the pool (file reads for
+downloads use a large block size) and sent with await, so a slow download
+holds no thread while the client catches up. Merges already run on the
+merge worker processes, so they use separate cores.
+"""
+
+import asyncio
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app
+
+# Request bodies larger than this are spooled to disk instead of memory
+SPOOL_MEMORY = 1024 * 1024
+# Bytes read per chunk of a file response
+FILE_BLOCK_SIZE = 256 * 1024
+
+
+class FileWrapper:
+    """wsgi.file_wrapper reading in FILE_BLOCK_SIZE blocks, so a download takes few pool hops"""
+
+    def __init__(self, file, buffer_size=8192):
+        self.file = file
+        self.buffer_size = max(buffer_size, FILE_BLOCK_SIZE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(self.buffer_size)
+        if not data:
+            raise StopIteration()
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class _StartResponse:
+    def __init__(self):
+        self.status = None
+        self.headers = None
+
+    def __call__(self, status, headers, exc_info=None):
+        if exc_info and self.status is not None:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers]
+
+
+class AsgiAdapter:
+    """Runs a WSGI application under an ASGI server without blocking the event loop"""
+
+    def __init__(self, wsgi_app, threads=64, max_body=None):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, scope, receive):
+        """Spool the request body, returns (file, length)
+
+        Past max_body the rest of the body is not read; length is then what
+        was received so far, which the app rejects with its own 413.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        length = 0
+        declared = _header(scope, b'content-length')
+        if declared is not None and self.max_body is not None and int(declared) > self.max_body:
+            return body, int(declared)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise _Disconnected()
+            chunk = message.get('body', b'')
+            length += len(chunk)
+            if self.max_body is not None and length > self.max_body:
+                break
+            # Page-cache writes of one network chunk; not worth a pool hop
+            body.write(chunk)
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body, length
+
+    async def _http(self, scope, receive, send):
+        try:
+            body, length = await self._read_body(scope, receive)
+        except _Disconnected:
+            return
+        loop = asyncio.get_running_loop()
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        start_response = _StartResponse()
+        iterable = None
+        try:
+            environ = _environ(scope, body, length)
+            iterable = await loop.run_in_executor(self.executor, self.wsgi_app, environ,
+                                                  start_response)
+            iterator = iter(iterable)
+            # Generators may only call start_response with their first chunk
+            chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send({'type': 'http.response.start', 'status': start_response.status,
+                        'headers': start_response.headers})
+            while chunk is not None and not disconnected.done():
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+            body.close()
+
+
+class _Disconnected(Exception):
+    """The client went away before its request body was complete"""
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _environ(scope, body, length):
+    """WSGI environ of an ASGI http scope (PEP 3333 strings are latin-1 decoded bytes)"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    for key, value in scope['headers']:
+        key = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if key == 'CONTENT_LENGTH':
+            continue
+        key = f"HTTP_{key}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+app = AsgiAdapter(flask_app, threads=flask_app.config['ASGI_THREADS'],
+                  max_body=flask_app.config['MAX_CONTENT_LENGTH'])
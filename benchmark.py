@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the upload, merge and download paths
+Generates synthetic PDF corpora, then times page counting and merge_pdfs directly and
+/api/upload, /api/merge and /download_file through the Flask test client.
+Each scenario runs in a fresh process so its peak RSS is its own. Results
+can be saved as a baseline and later runs compared against it:
+
+    python benchmark.py --quick --save baseline.json
+    python benchmark.py --quick --baseline baseline.json
+
+The comparison exits with status 1 when a scenario's p50 latency or
+throughput is worse than the baseline by more than --threshold.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+import subprocess
+
+from merger import PdfStreamWriter
+
+# name -> (files, pages per file) at full size and with --quick
+CORPORA = {
+    'small': {'full': (200, 1), 'quick': (40, 1)},
+    'huge': {'full': (3, 2000), 'quick': (2, 300)},
+    'images': {'full': (10, 5), 'quick': (3, 3)},
+    'fonts': {'full': (30, 3), 'quick': (10, 3)},
+    'scans': {'full': (1, 1000), 'quick': (1, 100)},
+}
+IMAGE_SIZE = (600, 800)  # grayscale pixels per page of the images and scans corpora
+SCAN_VARIANTS = 8        # distinct images a scans file cycles through, each page its own copy
+FONT_SIZE = 200 * 1024   # bytes of the font program shared by the fonts corpus
+
+
+def _page_text(number):
+    return b'BT /F1 12 Tf 72 720 Td (Benchmark page %d) Tj ET' % number
+
+
+def write_pdf(path, pages, kind, rng, shared_font):
+    """Write a synthetic PDF of the given corpus kind"""
+    with open(path, 'wb') as output:
+        writer = PdfStreamWriter(output)
+        if kind == 'fonts':
+            font_file = writer.allocate()
+            writer.write_object(font_file, b'<< /Length %d /Length1 %d >>\nstream\n'
+                                % (len(shared_font), len(shared_font)) + shared_font + b'\nendstream')
+            descriptor = writer.allocate()
+            writer.write_object(descriptor, b'<< /Type /FontDescriptor /FontName /BenchSans '
+                                b'/Flags 32 /FontBBox [0 0 1000 1000] /ItalicAngle 0 /Ascent 800 '
+                                b'/Descent -200 /CapHeight 700 /StemV 80 /FontFile2 %d 0 R >>'
+                                % font_file)
+            font = writer.allocate()
+            writer.write_object(font, b'<< /Type /Font /Subtype /TrueType /BaseFont /BenchSans '
+                                b'/FirstChar 32 /LastChar 32 /Widths [250] /FontDescriptor %d 0 R >>'
+                                % descriptor)
+        else:
+            font = writer.allocate()
+            writer.write_object(font, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+        variants = []
+        for number in range(1, pages + 1):
+            resources = b'/Font << /F1 %d 0 R >>' % font
+            content = _page_text(number)
+            if kind in ('images', 'scans'):
+                width, height = IMAGE_SIZE
+                if kind == 'scans' and len(variants) == SCAN_VARIANTS:
+                    data = variants[(number - 1) % SCAN_VARIANTS]
+                else:
+                    # Noise in the low bits so it compresses like a scan, not like a blank page
+                    pixels = bytes(rng.getrandbits(4) + 120 for _ in range(width * height))
+                    data = zlib.compress(pixels)
+                    if kind == 'scans':
+                        variants.append(data)
+                image = writer.allocate()
+                writer.write_object(image, b'<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+                                    b'/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode '
+                                    b'/Length %d >>\nstream\n' % (width, height, len(data))
+                                    + data + b'\nendstream')
+                resources += b' /XObject << /Im1 %d 0 R >>' % image
+                content = b'q 540 720 0 0 36 36 cm /Im1 Do Q ' + content
+            contents = writer.allocate()
+            writer.write_object(contents, b'<< /Length %d >>\nstream\n' % len(content)
+                                + content + b'\nendstream')
+            page = writer.allocate()
+            writer.write_object(page, b'<< /Type /Page /Parent 1 0 R /MediaBox [0 0 612 792] '
+                                b'/Resources << %s >> /Contents %d 0 R >>' % (resources, contents))
+            writer.page_numbers.append(page)
+        writer.close()
+
+
+def generate_corpora(folder, size):
+    """Create every corpus below folder, returns name -> list of paths"""
+    rng = random.Random(1234)
+    shared_font = rng.randbytes(FONT_SIZE)
+    corpora = {}
+    for name, sizes in CORPORA.items():
+        files, pages = sizes[size]
+        corpus_folder = os.path.join(folder, name)
+        os.makedirs(corpus_folder, exist_ok=True)
+        paths = []
+        for i in range(files):
+            path = os.path.join(corpus_folder, f"{name}_{i:04d}.pdf")
+            write_pdf(path, pages, name, rng, shared_font)
+            paths.append(path)
+        corpora[name] = paths
+    return corpora
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """Peak resident size of this process and its finished children, in MB
+
+    Children only count once they have exited and been waited for.
+    """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def summarize(latencies, pages, nbytes):
+    total = sum(latencies)
+    return {
+        'runs': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'ops_per_s': round(len(latencies) / total, 2),
+        'pages_per_s': round(pages * len(latencies) / total, 1),
+        'mb_per_s': round(nbytes * len(latencies) / total / (1024 * 1024), 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _time(func, runs):
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def _import_app(workdir):
+    """Import the app with its folders inside workdir, caches that never hit and no rate limit"""
+    os.chdir(workdir)
+    os.environ['CLEANUP_INTERVAL'] = '0'
+    os.environ['RATE_LIMIT_RATE'] = '0'
+    import app as app_module
+    # Every put evicts itself, so repeated merges are really merged
+    app_module.merge_result_cache.max_bytes = 0
+    return app_module
+
+
+def _upload(client, paths):
+    files = [(open(path, 'rb'), os.path.basename(path)) for path in paths]
+    try:
+        response = client.post('/api/upload', data={'files': files},
+                               content_type='multipart/form-data')
+    finally:
+        for f, _ in files:
+            f.close()
+    data = response.get_json()
+    if data.get('status') != 'success':
+        raise RuntimeError(f"Upload failed: {data}")
+    return data
+
+
+def run_scenario(kind, paths, pages, runs, workdir):
+    """Run one scenario in this process and return its summary
+
+    pages is the total page count of paths.
+    """
+    nbytes = sum(os.path.getsize(path) for path in paths)
+
+    if kind.endswith('+nommap'):
+        import mapped_file
+        # Read every file into memory, as PyPDF2 does when given a path
+        mapped_file.MMAP_THRESHOLD = float('inf')
+        kind = kind[:-len('+nommap')]
+
+    if kind.startswith('page_count'):
+        from pdf_cache import parse_pdf_info, read_pdf_info
+        # +full walks the page tree with PyPDF2, as read_pdf_info does for damaged files
+        read = parse_pdf_info if kind.endswith('+full') else read_pdf_info
+        latencies = _time(lambda: [read(path) for path in paths], runs)
+        return summarize(latencies, pages, nbytes)
+
+    if kind.startswith('merge_direct'):
+        from merger import merge_pdfs
+        output = os.path.join(workdir, 'out.pdf')
+        dedupe = kind.endswith('+dedupe')
+        latencies = _time(lambda: merge_pdfs(paths, output, dedupe=dedupe), runs)
+        return summarize(latencies, pages, nbytes)
+
+    app_module = _import_app(workdir)
+    try:
+        latencies, nbytes = _run_app_scenario(app_module, kind, paths, runs, nbytes)
+    finally:
+        _stop_workers(app_module)
+    return summarize(latencies, pages, nbytes)
+
+
+def _stop_workers(app_module):
+    """Shut the app's worker pools down and wait, so RUSAGE_CHILDREN counts them"""
+    for pool in (app_module.merge_queue, app_module.parse_pool):
+        if pool._executor is not None:
+            pool._executor.shutdown(wait=True)
+            pool._executor = None
+
+
+def _run_app_scenario(app_module, kind, paths, runs, nbytes):
+    """(latencies, bytes per run) of a scenario that goes through the app"""
+    client = app_module.app.test_client()
+
+    if kind == 'api_upload':
+        return _time(lambda: _upload(client, paths), runs), nbytes
+
+    session_id = _upload(client, paths)['session_id']
+
+    if kind == 'api_merge_stream':
+        def merge_streamed():
+            response = client.post('/api/merge', json={'session_id': session_id, 'stream': True})
+            if response.status_code != 200:
+                raise RuntimeError(f"Streamed merge failed: {response.status_code}")
+            # The body is generated while it is read
+            response.get_data()
+        return _time(merge_streamed, runs), nbytes
+
+    counter = iter(range(1000000))
+
+    def merge_queued():
+        output_filename = f"bench_{next(counter)}.pdf"
+        response = client.post('/api/merge', json={'session_id': session_id,
+                                                   'output_filename': output_filename})
+        status_url = response.get_json()['status_url']
+        while True:
+            status = client.get(status_url).get_json()
+            if status['status'] == 'completed':
+                return output_filename
+            if status['status'] == 'failed':
+                raise RuntimeError(f"Merge failed: {status}")
+            time.sleep(0.005)
+
+    if kind == 'api_merge':
+        return _time(merge_queued, runs), nbytes
+
+    if kind == 'download':
+        output_filename = merge_queued()
+        size = os.path.getsize(os.path.join('output', output_filename))
+
+        def download():
+            response = client.get(f'/download_file/{output_filename}')
+            if len(response.get_data()) != size:
+                raise RuntimeError('Short download')
+        return _time(download, runs * 10), size
+
+    raise ValueError(f"Unknown scenario: {kind}")
+
+
+def run_isolated(kind, paths, pages, runs, workdir):
+    """Run one scenario in a fresh interpreter so peak RSS is its own"""
+    os.makedirs(workdir, exist_ok=True)
+    job = json.dumps({'kind': kind, 'paths': paths, 'pages': pages, 'runs': runs,
+                      'workdir': workdir})
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', job],
+                               capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        raise RuntimeError(f"{kind} failed:\n{completed.stderr.strip()}")
+    # The summary is the last line of output
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+SCENARIOS = ['page_count', 'merge_direct', 'api_upload', 'api_merge', 'api_merge_stream', 'download']
+
+
+def run_all(size, runs, only=None):
+    results = {}
+    folder = tempfile.mkdtemp(prefix='pdf-bench-')
+    try:
+        print(f"Generating {size} corpora in {folder}")
+        corpora = generate_corpora(os.path.join(folder, 'corpora'), size)
+        plan = [(kind, corpus) for corpus in corpora for kind in SCENARIOS]
+        plan.append(('merge_direct+dedupe', 'fonts'))
+        plan.append(('page_count+full', 'scans'))
+        plan.append(('page_count+full+nommap', 'scans'))
+        for kind, corpus in plan:
+            name = f"{kind}/{corpus}"
+            if only and not any(part in name for part in only):
+                continue
+            workdir = os.path.join(folder, 'run', name.replace('/', '_'))
+            pages = len(corpora[corpus]) * CORPORA[corpus][size][1]
+            summary = run_isolated(kind, corpora[corpus], pages, runs, workdir)
+            results[name] = summary
+            print(f"{name:32} p50 {summary['p50_ms']:>9.2f} ms  p99 {summary['p99_ms']:>9.2f} ms  "
+                  f"{summary['ops_per_s']:>8.2f} ops/s  {summary['pages_per_s']:>9.1f} pages/s  "
+                  f"{summary['mb_per_s']:>7.2f} MB/s  rss {summary['peak_rss_mb']:>7.1f} MB")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print changes against a baseline, returns the names of regressed scenarios"""
+    regressions = []
+    print(f"\nCompared with baseline (threshold {threshold:.0%}):")
+    for name, summary in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            print(f"{name:32} new")
+            continue
+        latency = summary['p50_ms'] / previous['p50_ms'] - 1 if previous['p50_ms'] else 0
+        throughput = summary['ops_per_s'] / previous['ops_per_s'] - 1 if previous['ops_per_s'] else 0
+        rss = summary['peak_rss_mb'] - previous['peak_rss_mb']
+        regressed = latency > threshold or throughput < -threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:32} p50 {latency:+7.1%}  throughput {throughput:+7.1%}  rss {rss:+7.1f} MB"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='small corpora, for CI')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per scenario')
+    parser.add_argument('--only', nargs='*', help='run scenarios whose name contains any of these')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown before a scenario counts as a regression')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)  # internal, see run_isolated
+    args = parser.parse_args()
+
+    if args.scenario:
+        job = json.loads(args.scenario)
+        print(json.dumps(run_scenario(job['kind'], job['paths'], job['pages'], job['runs'],
+                                      job['workdir'])), flush=True)
+        return
+
+    size = 'quick' if args.quick else 'full'
+    results = run_all(size, args.runs, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'size': size, 'runs': args.runs, 'python': sys.version.split()[0],
+                       'created': time.time(), 'results': results}, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('size') != size:
+            print(f"Warning: baseline was recorded with {baseline.get('size')} corpora")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
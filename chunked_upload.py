@@ -0,0 +1,170 @@
+"""
+Resumable chunked uploads
+A large file is sent as a series of PUT requests, each carrying the next
+chunk at the offset the server has received so far, with the SHA-256 of
+the chunk. Chunks are written in place into a .part file and the progress
+is kept in a small JSON state file next to it, so any server process can
+take the next chunk and an interrupted upload resumes from the last
+verified chunk. Finalizing checks the size, the PDF header and trailer and
+an optional SHA-256 of the whole file, then moves the file into its
+session folder like a normal upload.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from ingest import UploadRejected, check_pdf_file
+from pdf_cache import file_sha256
+
+# Bytes read from the request body at a time
+READ_SIZE = 64 * 1024
+
+
+class ChunkRejected(Exception):
+    """Raised when a chunk cannot be accepted; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkedUploads:
+    """State and data of in-progress chunked uploads in one folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def part_path(self, upload_id):
+        return os.path.join(self.folder, f"{upload_id}.part")
+
+    def state_path(self, upload_id):
+        return os.path.join(self.folder, f"{upload_id}.json")
+
+    def _write_state(self, state):
+        path = self.state_path(state['upload_id'])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def create(self, session_id, filename, size):
+        """Start an upload of size bytes that will become filename in session_id"""
+        upload_id = uuid.uuid4().hex
+        state = {'upload_id': upload_id, 'session_id': session_id, 'filename': filename,
+                 'size': size, 'received': 0, 'chunks': [], 'created': time.time()}
+        open(self.part_path(upload_id), 'wb').close()
+        self._write_state(state)
+        return state
+
+    def _open_part(self, upload_id):
+        """The .part file, locked: one writer (or finalize) per upload at a time"""
+        try:
+            part = open(self.part_path(upload_id), 'r+b') if upload_id.isalnum() else None
+        except FileNotFoundError:
+            part = None
+        if part is None:
+            raise ChunkRejected('Upload not found', 404)
+        fcntl.flock(part, fcntl.LOCK_EX)
+        return part
+
+    def get(self, upload_id):
+        """State of an upload, or None if it is unknown (or already finalized)"""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(self.state_path(upload_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_chunk(self, upload_id, offset, stream, sha256, max_chunk):
+        """Append the body of stream at offset
+
+        Returns the updated state and the bytes newly stored. offset must be
+        the number of bytes received so far. A chunk that was already
+        received (same offset, length and checksum, e.g. a retry after a
+        lost response) is accepted without writing it again, and stores 0
+        bytes. The chunk only counts once its SHA-256 matches; raises
+        ChunkRejected.
+        """
+        sha256 = sha256.lower()
+        with self._open_part(upload_id) as part:
+            state = self.get(upload_id)
+            if state is None:
+                raise ChunkRejected('Upload not found', 404)
+            if offset != state['received']:
+                if any(chunk['offset'] == offset and chunk['sha256'] == sha256
+                       for chunk in state['chunks']):
+                    _drain(stream)
+                    return state, 0
+                raise ChunkRejected(f"Expected offset {state['received']}, got {offset}", 409)
+
+            part.seek(offset)
+            digest = hashlib.sha256()
+            length = 0
+            limit = min(max_chunk, state['size'] - offset)
+            for data in iter(lambda: stream.read(READ_SIZE), b''):
+                length += len(data)
+                if length > limit:
+                    # Nothing past received counts, so the partial write is harmless
+                    part.truncate(offset)
+                    raise ChunkRejected(f"Chunk exceeds {limit} bytes", 413)
+                digest.update(data)
+                part.write(data)
+            if length == 0:
+                raise ChunkRejected('Empty chunk')
+            if digest.hexdigest() != sha256:
+                part.truncate(offset)
+                raise ChunkRejected('Chunk checksum mismatch')
+            part.flush()
+
+            state['received'] = offset + length
+            state['chunks'].append({'offset': offset, 'length': length, 'sha256': digest.hexdigest()})
+            self._write_state(state)
+            return state, length
+
+    def finalize(self, upload_id, dest, sha256=None):
+        """Validate a complete upload and move it to dest
+
+        Returns the header/trailer info of the file with its SHA-256, like
+        ingest.save_upload; raises ChunkRejected, UploadRejected for a
+        file that is not a PDF (the upload is removed then), or OSError if
+        dest cannot be written, e.g. because its folder has expired.
+        """
+        with self._open_part(upload_id):
+            state = self.get(upload_id)
+            if state is None:
+                raise ChunkRejected('Upload not found', 404)
+            if state['received'] != state['size']:
+                raise ChunkRejected(f"Upload incomplete: {state['received']} of {state['size']} bytes",
+                                    409)
+            part_path = self.part_path(upload_id)
+            digest = file_sha256(part_path)
+            if sha256 and digest != sha256.lower():
+                raise ChunkRejected('File checksum mismatch')
+            try:
+                info = check_pdf_file(part_path)
+            except UploadRejected:
+                self.discard(upload_id)
+                raise
+            os.replace(part_path, dest)
+            os.remove(self.state_path(upload_id))
+        info['sha256'] = digest
+        return info
+
+    def discard(self, upload_id):
+        for path in (self.part_path(upload_id), self.state_path(upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _drain(stream):
+    for _ in iter(lambda: stream.read(READ_SIZE), b''):
+        pass
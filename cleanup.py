@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 """
-Cleanup script to remove old uploaded and output files
-Run this periodically to prevent disk space issues
+Cleanup script to remove expired uploaded and output files
+The app sweeps its expiry index in a background thread (CLEANUP_INTERVAL);
+run this instead when that thread is disabled, e.g. from cron. Use --scan
+to also walk the folders for files the index does not know about.
 """
 
+import argparse
 import os
 import time
 from datetime import datetime, timedelta
 
+from expiry import CleanupService, ExpiryIndex
+from history_store import MergeHistory
+from session_store import SQLiteSessionStore
+
 def cleanup_old_files(directory, max_age_hours=24):
     """Remove files older than max_age_hours"""
     if not os.path.exists(directory):
@@ -40,14 +47,37 @@ def cleanup_old_files(directory, max_age_hours=24):
     return removed_count
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scan', action='store_true',
+                        help='also walk uploads/, output/ and jobs/ for files older than their TTL')
+    args = parser.parse_args()
+    upload_hours = int(os.environ.get('UPLOAD_TTL', 24 * 3600)) / 3600
+    output_hours = int(os.environ.get('OUTPUT_TTL', 48 * 3600)) / 3600
+    
     print(f"Starting cleanup at {datetime.now()}")
     
-    # Clean uploads (24 hours)
-    uploads_removed = cleanup_old_files('uploads', 24)
-    print(f"Removed {uploads_removed} uploaded files")
+    # Delete what is due in the expiry index, and expire upload manifests
+    session_store = None
+    if os.path.exists('data/sessions.sqlite3'):
+        session_store = SQLiteSessionStore('data/sessions.sqlite3')
+    service = CleanupService(ExpiryIndex('data/expiry.sqlite3'), session_store=session_store,
+                             session_max_age=upload_hours * 3600)
+    stats = service.run_once()
+    print(f"Removed {stats['removed']} expired entries, reclaimed {stats['bytes_reclaimed']} bytes")
+    print(f"Postponed {stats['skipped']} entries still in use, {stats['errors']} errors")
+    print(f"Removed {stats.get('sessions_removed', 0)} upload sessions")
+    
+    if args.scan:
+        # Full walk for leftovers from before the expiry index, or crashed uploads
+        print(f"Removed {cleanup_old_files('uploads', upload_hours)} uploaded files")
+        print(f"Removed {cleanup_old_files('output', output_hours)} output files")
+        print(f"Removed {cleanup_old_files('jobs', output_hours)} job status files")
     
-    # Clean outputs (48 hours - give users more time to download)
-    outputs_removed = cleanup_old_files('output', 48)
-    print(f"Removed {outputs_removed} output files")
+    # Apply merge history retention (app.py also prunes as rows are added)
+    if os.path.exists('data/history.sqlite3'):
+        history = MergeHistory('data/history.sqlite3',
+                               max_rows=int(os.environ.get('HISTORY_MAX_ROWS', 1000000)),
+                               max_age_days=int(os.environ.get('HISTORY_RETENTION_DAYS', 90)))
+        print(f"Removed {history.prune()} merge history rows")
     
-    print(f"Cleanup completed at {datetime.now()}")
\ No newline at end of file
+    print(f"Cleanup completed at {datetime.now()}")
@@ -0,0 +1,166 @@
+"""
+Incremental cleanup of uploads and outputs
+Every upload folder, merge output and job status file is recorded with its
+expiry time when it is created, in a SQLite table indexed by expiry. A
+sweep only visits entries that are due, so its cost follows the number of
+expired files rather than everything on disk. An entry whose path was
+modified after it was scheduled is still in use and is pushed back instead
+of deleted; writing a session's manifest reschedules its folder as well.
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+# Seconds before an entry that could not be deleted is tried again
+RETRY_DELAY = 600
+# Entries handled per sweep batch
+SWEEP_BATCH = 1000
+
+log = logging.getLogger(__name__)
+
+
+def _path_size(path):
+    """Bytes used by a file, or by all files below a folder"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ExpiryIndex:
+    """Time-ordered index of paths to delete once they expire"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS expiry ('
+                         'path TEXT PRIMARY KEY, kind TEXT NOT NULL, ttl REAL NOT NULL, '
+                         'scheduled REAL NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS expiry_expires ON expiry (expires)')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def schedule(self, path, ttl, kind='file'):
+        """Delete path ttl seconds from now (or from its next use)"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO expiry (path, kind, ttl, scheduled, expires) '
+                         'VALUES (?, ?, ?, ?, ?)', (os.path.abspath(path), kind, ttl, now, now + ttl))
+
+    def pending(self):
+        """Number of scheduled entries"""
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT COUNT(*) FROM expiry').fetchone()[0]
+
+    def sweep(self, limit=SWEEP_BATCH, now=None):
+        """Delete up to limit due entries
+
+        Returns counts of entries checked, removed, pushed back because they
+        were still in use, and deletion errors, plus the bytes reclaimed.
+        """
+        now = time.time() if now is None else now
+        stats = {'checked': 0, 'removed': 0, 'bytes_reclaimed': 0, 'skipped': 0, 'errors': 0}
+        with closing(self._connect()) as conn:
+            due = conn.execute('SELECT path, kind, ttl, scheduled FROM expiry WHERE expires <= ? '
+                               'ORDER BY expires LIMIT ?', (now, limit)).fetchall()
+            stats['checked'] = len(due)
+            for path, kind, ttl, scheduled in due:
+                try:
+                    modified = os.path.getmtime(path)
+                except OSError:
+                    # Already gone (removed by hand, or by the result cache)
+                    with conn:
+                        conn.execute('DELETE FROM expiry WHERE path = ?', (path,))
+                    continue
+
+                if modified > scheduled and modified + ttl > now:
+                    with conn:
+                        conn.execute('UPDATE expiry SET scheduled = ?, expires = ? WHERE path = ?',
+                                     (modified, modified + ttl, path))
+                    stats['skipped'] += 1
+                    continue
+
+                try:
+                    size = _path_size(path)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except OSError as e:
+                    log.warning('Error removing %s: %s', path, e)
+                    with conn:
+                        conn.execute('UPDATE expiry SET expires = ? WHERE path = ?',
+                                     (now + RETRY_DELAY, path))
+                    stats['errors'] += 1
+                    continue
+                with conn:
+                    conn.execute('DELETE FROM expiry WHERE path = ?', (path,))
+                stats['removed'] += 1
+                stats['bytes_reclaimed'] += size
+        return stats
+
+
+class CleanupService:
+    """Runs ExpiryIndex sweeps (and manifest expiry) periodically in a daemon thread"""
+
+    def __init__(self, index, interval=300, session_store=None, session_max_age=24 * 3600):
+        self.index = index
+        self.interval = interval
+        self.session_store = session_store
+        self.session_max_age = session_max_age
+        self.totals = {'runs': 0, 'checked': 0, 'removed': 0, 'bytes_reclaimed': 0,
+                       'skipped': 0, 'errors': 0, 'sessions_removed': 0, 'last_run': None}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def run_once(self):
+        """Sweep everything that is due now, returns the stats of this run"""
+        stats = {'checked': 0, 'removed': 0, 'bytes_reclaimed': 0, 'skipped': 0, 'errors': 0}
+        while True:
+            batch = self.index.sweep()
+            for key in stats:
+                stats[key] += batch[key]
+            # A short batch means nothing else is due
+            if batch['checked'] < SWEEP_BATCH:
+                break
+        if self.session_store is not None:
+            stats['sessions_removed'] = self.session_store.purge(self.session_max_age)
+        with self._lock:
+            for key, value in stats.items():
+                self.totals[key] += value
+            self.totals['runs'] += 1
+            self.totals['last_run'] = time.time()
+        return stats
+
+    def start(self):
+        """Start the background thread (once per process)"""
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._thread = threading.Thread(target=self._run, name='cleanup', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                stats = self.run_once()
+                if stats['removed']:
+                    log.info('Cleanup removed %s entries, %s bytes reclaimed',
+                             stats['removed'], stats['bytes_reclaimed'])
+            except Exception as e:
+                log.warning('Cleanup run failed: %s', e)
@@ -0,0 +1,123 @@
+"""
+Persistent merge history
+Merges are recorded in an embedded SQLite database shared by all worker
+processes. Pages are read with keyset (cursor) pagination on the row id, so
+listing stays cheap however many rows there are; date filters are turned
+into id bounds through the index on created, and filename filters are
+prefix matches served by a case-insensitive index. Old rows are pruned by
+age and by count.
+"""
+
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime
+
+# Prune retention limits once every this many inserts
+PRUNE_INTERVAL = 1000
+
+
+class MergeHistory:
+    """SQLite-backed merge history with bounded retention"""
+
+    def __init__(self, db_path, max_rows=1000000, max_age_days=90):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.max_age_days = max_age_days
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS merge_history ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, '
+                         'output_file TEXT NOT NULL COLLATE NOCASE, input_files TEXT NOT NULL, '
+                         'input_count INTEGER NOT NULL, pages INTEGER NOT NULL, '
+                         'size INTEGER NOT NULL, status TEXT NOT NULL, source TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS merge_history_created ON merge_history (created)')
+            conn.execute('CREATE INDEX IF NOT EXISTS merge_history_output_file '
+                         'ON merge_history (output_file)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(self, output_file, input_files, pages, size, status='completed', source='web'):
+        """Append a merge to the history"""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                'INSERT INTO merge_history (created, output_file, input_files, input_count, '
+                'pages, size, status, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (time.time(), output_file, '\n'.join(input_files), len(input_files),
+                 pages, size, status, source))
+            if cursor.lastrowid % PRUNE_INTERVAL == 0:
+                self._prune(conn)
+
+    def prune(self):
+        """Apply the retention limits now, returns how many rows were removed"""
+        with closing(self._connect()) as conn, conn:
+            return self._prune(conn)
+
+    def _prune(self, conn):
+        removed = conn.execute('DELETE FROM merge_history WHERE created < ?',
+                               (time.time() - self.max_age_days * 86400,)).rowcount
+        row = conn.execute('SELECT id FROM merge_history ORDER BY id DESC LIMIT 1 OFFSET ?',
+                           (self.max_rows,)).fetchone()
+        if row is not None:
+            removed += conn.execute('DELETE FROM merge_history WHERE id <= ?', (row['id'],)).rowcount
+        return removed
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM merge_history')
+
+    def page(self, cursor=None, limit=50, since=None, until=None, filename=None):
+        """One page of history, newest first
+
+        cursor is the next_cursor of the previous page; since/until are
+        timestamps bounding created, filename a case-insensitive prefix of
+        the output file name. Returns (items, next_cursor), next_cursor
+        being None on the last page.
+        """
+        clauses = []
+        params = []
+        with closing(self._connect()) as conn:
+            # Ids grow with created, so a date range is an id range
+            if since is not None:
+                row = conn.execute('SELECT id FROM merge_history WHERE created >= ? '
+                                   'ORDER BY created LIMIT 1', (since,)).fetchone()
+                clauses.append('id >= ?')
+                params.append(row[0] if row is not None else float('inf'))
+            if until is not None:
+                row = conn.execute('SELECT id FROM merge_history WHERE created >= ? '
+                                   'ORDER BY created LIMIT 1', (until,)).fetchone()
+                if row is not None:
+                    clauses.append('id < ?')
+                    params.append(row[0])
+            if cursor is not None:
+                clauses.append('id < ?')
+                params.append(cursor)
+            if filename:
+                escaped = filename.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                clauses.append("output_file LIKE ? ESCAPE '\\'")
+                params.append(escaped + '%')
+            where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+            rows = conn.execute(f'SELECT * FROM merge_history {where} ORDER BY id DESC LIMIT ?',
+                                params + [limit + 1]).fetchall()
+
+        items = [self._item(row) for row in rows[:limit]]
+        next_cursor = items[-1]['id'] if len(rows) > limit else None
+        return items, next_cursor
+
+    def _item(self, row):
+        return {
+            'id': row['id'],
+            'date': datetime.fromtimestamp(row['created']).strftime('%Y-%m-%d %H:%M:%S'),
+            'output_file': row['output_file'],
+            'input_files': row['input_files'].split('\n') if row['input_files'] else [],
+            'input_count': row['input_count'],
+            'pages': row['pages'],
+            'size': row['size'],
+            'status': row['status'],
+            'source': row['source']
+        }
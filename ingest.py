@@ -0,0 +1,175 @@
+"""
+Streaming PDF upload ingestion
+Uploaded file parts are written to disk chunk by chunk as the request body
+is parsed, and checked for a PDF header and trailer on the way. Non-PDFs
+stop being written as soon as the header is wrong, and accepted files are
+moved into their session folder instead of being copied.
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# The PDF header must appear within the first 1024 bytes of the file
+HEADER_WINDOW = 1024
+# startxref / %%EOF are looked for in this many trailing bytes
+TAIL_WINDOW = 2048
+
+HEADER_RE = re.compile(rb'%PDF-(\d\.\d)')
+_STARTXREF_RE = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+
+
+class UploadRejected(Exception):
+    """Raised when an uploaded file is not a usable PDF"""
+
+
+class IngestFile:
+    """Writable upload container that streams a file part to disk"""
+
+    def __init__(self, folder, max_size):
+        os.makedirs(folder, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=folder, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self.max_size = max_size
+        self.size = 0
+        self.version = None
+        self.error = None
+        self.committed = False
+        self._head = b''
+        self._tail = b''
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        if self.error:
+            return len(data)  # already rejected, drop the rest of the part
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.discard('File too large')
+            raise RequestEntityTooLarge()
+        if self.version is None:
+            self._head = (self._head + data)[:HEADER_WINDOW]
+            match = HEADER_RE.search(self._head)
+            if match:
+                self.version = match.group(1).decode()
+            elif len(self._head) >= HEADER_WINDOW:
+                self.discard('Missing %PDF- header')
+                return len(data)
+        self._tail = (self._tail + data)[-TAIL_WINDOW:]
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def discard(self, reason):
+        """Stop writing and remove the partial file"""
+        self.error = reason
+        self._close_and_unlink()
+        # Keep a readable stream around for werkzeug's FileStorage
+        self._file = io.BytesIO()
+
+    def finish(self):
+        """Validate the completed upload and return what was learned about it"""
+        if self.error is None and self.version is None:
+            self.discard('Missing %PDF- header')
+        if self.error is None:
+            match = None
+            for match in _STARTXREF_RE.finditer(self._tail):
+                pass
+            if match is None:
+                self.discard('Missing startxref/%%EOF trailer')
+            elif int(match.group(1)) >= self.size:
+                self.discard('startxref points past the end of the file')
+        if self.error:
+            raise UploadRejected(self.error)
+        return {'size': self.size, 'version': self.version,
+                'startxref': int(match.group(1)),
+                'sha256': self._sha256.hexdigest()}
+
+    def commit(self, dest):
+        """Move the validated file to dest"""
+        self._file.close()
+        os.replace(self.path, dest)
+        self.committed = True
+
+    def close(self):
+        if not self.committed:
+            self._close_and_unlink()
+
+    def _close_and_unlink(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __getattr__(self, name):
+        # read/seek/readline etc. go to the underlying file
+        return getattr(self._file, name)
+
+
+class IngestRequest(Request):
+    """Request class that streams uploaded files through IngestFile"""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        max_size = current_app.config.get('MAX_FILE_SIZE')
+        if max_size is not None and content_length and content_length > max_size:
+            raise RequestEntityTooLarge()
+        folder = os.path.join(current_app.config['UPLOAD_FOLDER'], '.incoming')
+        stream = IngestFile(folder, max_size)
+        self._ingest_files.append(stream)
+        return stream
+
+    @property
+    def _ingest_files(self):
+        return self.__dict__.setdefault('_ingest_file_list', [])
+
+    def close(self):
+        super().close()
+        # Parts parsed before an aborted request never reach request.files
+        for stream in self._ingest_files:
+            stream.close()
+
+
+def check_pdf_file(filepath):
+    """Header/trailer check for a PDF that is already on disk
+
+    Unlike IngestFile this does not hash the file.
+    """
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        head = f.read(HEADER_WINDOW)
+        f.seek(max(0, size - TAIL_WINDOW))
+        tail = f.read()
+    header = HEADER_RE.search(head)
+    trailer = None
+    for trailer in _STARTXREF_RE.finditer(tail):
+        pass
+    if header is None:
+        raise UploadRejected('Missing %PDF- header')
+    if trailer is None or int(trailer.group(1)) >= size:
+        raise UploadRejected('Missing startxref/%%EOF trailer')
+    return {'size': size, 'version': header.group(1).decode(),
+            'startxref': int(trailer.group(1))}
+
+
+def save_upload(file, filepath):
+    """Store an uploaded FileStorage at filepath, rejecting non-PDFs
+
+    Returns the header/trailer info of the file (plus its SHA-256 when it
+    was streamed); raises UploadRejected.
+    """
+    stream = file.stream
+    if isinstance(stream, IngestFile):
+        info = stream.finish()
+        stream.commit(filepath)
+        return info
+    file.save(filepath)
+    try:
+        return check_pdf_file(filepath)
+    except UploadRejected:
+        os.remove(filepath)
+        raise
@@ -0,0 +1,420 @@
+"""
+Background merge job queue
+Merges run in a pool of worker processes; job state is kept in small JSON
+status files so any web worker can answer /api/status/<task_id>
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from merger import ReaderCache, merge_pdfs
+
+log = logging.getLogger(__name__)
+
+# Minimum seconds between progress writes from a running job
+PROGRESS_INTERVAL = 0.5
+
+
+class QueueFull(Exception):
+    """Raised when the merge queue has no free slots"""
+
+
+def _status_path(status_folder, task_id):
+    return os.path.join(status_folder, f"{task_id}.json")
+
+
+def write_status(status_folder, task_id, **fields):
+    """Atomically replace the status file of a job"""
+    fields['task_id'] = task_id
+    fields['updated'] = time.time()
+    path = _status_path(status_folder, task_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(fields, f)
+    os.replace(tmp_path, path)
+
+
+def read_status(status_folder, task_id):
+    """Return the status dict of a job, or None if it is unknown"""
+    try:
+        with open(_status_path(status_folder, task_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def completed_state(output_path, download_url, result):
+    """Status fields of a finished merge"""
+    return {'status': 'completed', 'progress': 100,
+            'pages_merged': result['pages'], 'total_pages': result['pages'],
+            'filename': os.path.basename(output_path), 'download_url': download_url,
+            'errors': result['errors'], 'bytes_saved': result['bytes_saved'],
+            'linearized': result.get('linearized', False),
+            # Cached results from before size_after was recorded lack it
+            'size': result.get('size_after') or os.path.getsize(output_path),
+            'size_before': result.get('size_before'), 'seconds': result.get('seconds'),
+            'compression_seconds': result.get('compression_seconds'),
+            'timings': result.get('timings')}
+
+
+def run_merge_job(status_folder, task_id, sources, output_path, download_url,
+                  total_pages=None, options=None, cache=None, cache_key=None, readers=None):
+    """Worker process entry point for a merge job
+
+    options are passed on to merge_pdfs (dedupe, linearize, interleave,
+    profile), as are readers. When cache and cache_key are given, a clean
+    result is stored in the merge result cache.
+    """
+    filename = os.path.basename(output_path)
+    state = {'status': 'running', 'progress': 0, 'pages_merged': 0,
+             'total_pages': total_pages, 'filename': filename}
+    write_status(status_folder, task_id, **state)
+    last_write = [0.0]
+
+    def report(pages_merged, total_pages):
+        now = time.monotonic()
+        if now - last_write[0] < PROGRESS_INTERVAL:
+            return
+        last_write[0] = now
+        state['pages_merged'] = pages_merged
+        if total_pages:
+            state['progress'] = min(99, int(pages_merged * 100 / total_pages))
+        write_status(status_folder, task_id, **state)
+
+    keep_path = cache.staging_path(cache_key) if cache is not None and cache_key else None
+    try:
+        result = merge_pdfs(sources, output_path, progress=report, total_pages=total_pages,
+                            readers=readers, keep_path=keep_path, **(options or {}))
+    except Exception as e:
+        log.warning('Merge job %s failed: %s', task_id, e)
+        state.update(status='failed', message=str(e))
+        write_status(status_folder, task_id, **state)
+        return state
+
+    if keep_path is not None:
+        try:
+            if not result['errors']:
+                cache.put(cache_key, keep_path, result)
+        except OSError as e:
+            log.warning('Could not cache merge result %s: %s', cache_key, e)
+        finally:
+            cache.discard(keep_path)
+
+    state = completed_state(output_path, download_url, result)
+    write_status(status_folder, task_id, **state)
+    return state
+
+
+def run_batch_job(status_folder, outputs, options=None, cache=None):
+    """Worker process entry point for several outputs of a batch
+
+    outputs are dicts with the run_merge_job arguments of each output.
+    They share a ReaderCache, so an input used by several of them is
+    opened and parsed once, and closed after the last output that uses it.
+    Returns the final state of every output.
+    """
+    inputs = [{_source_path(source) for source in output['sources']} for output in outputs]
+    uses = {}
+    for paths in inputs:
+        for path in paths:
+            uses[path] = uses.get(path, 0) + 1
+    readers = ReaderCache(uses)
+    states = []
+    try:
+        for output, paths in zip(outputs, inputs):
+            states.append(run_merge_job(status_folder, output['task_id'], output['sources'],
+                                        output['output_path'], output['download_url'],
+                                        output.get('total_pages'), options, cache,
+                                        output.get('cache_key'), readers=readers))
+            readers.finished(paths)
+        return states
+    finally:
+        readers.close()
+
+
+def plan_batch(outputs, workers):
+    """Split batch outputs into at most workers groups, one job each
+
+    Outputs that share an input go in the same group so the input is
+    parsed once, unless together they are more than a worker's share of
+    the pages; then they are split, and each piece parses the shared input
+    itself. Groups are balanced by page count. Returns lists of indexes
+    into outputs.
+    """
+    def weight(i):
+        return outputs[i].get('total_pages') or 1
+
+    # Union-find over outputs, joined through their input paths
+    parent = list(range(len(outputs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first_user = {}
+    for i, output in enumerate(outputs):
+        for source in output['sources']:
+            path = _source_path(source)
+            if path in first_user:
+                parent[find(i)] = find(first_user[path])
+            else:
+                first_user[path] = i
+
+    components = {}
+    for i in range(len(outputs)):
+        components.setdefault(find(i), []).append(i)
+
+    # One shared cover page must not put the whole batch on one worker
+    share = sum(weight(i) for i in range(len(outputs))) / max(1, workers)
+    pieces = []
+    for members in components.values():
+        piece, load = [], 0
+        for i in members:
+            if piece and load + weight(i) > share:
+                pieces.append(piece)
+                piece, load = [], 0
+            piece.append(i)
+            load += weight(i)
+        pieces.append(piece)
+
+    # Largest first into the lightest group
+    pieces.sort(key=lambda members: -sum(weight(i) for i in members))
+    groups = [[] for _ in range(min(workers, len(pieces)))]
+    loads = [0] * len(groups)
+    for members in pieces:
+        lightest = loads.index(min(loads))
+        groups[lightest].extend(members)
+        loads[lightest] += sum(weight(i) for i in members)
+    return [sorted(group) for group in groups]
+
+
+def _source_path(source):
+    return source.path if hasattr(source, 'path') else source
+
+
+def _source_name(source):
+    return source.name if hasattr(source, 'name') else os.path.basename(source)
+
+
+class JobQueue:
+    """Bounded queue of merge jobs backed by a process pool
+
+    With a history (history_store.MergeHistory), finished jobs are recorded
+    in it by the submitting process.
+    """
+
+    def __init__(self, status_folder, workers=2, max_depth=32, history=None):
+        self.status_folder = status_folder
+        self.workers = workers
+        self.max_depth = max_depth
+        self.history = history
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        os.makedirs(status_folder, exist_ok=True)
+
+    def _get_executor(self):
+        # Created lazily so the pool is forked from the serving process,
+        # not from whatever imported the app (e.g. a gunicorn master)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _submit(self, func, *args, **kwargs):
+        # Called with _lock held. A worker that died (e.g. out of memory)
+        # leaves the pool broken for good; start a fresh one and retry once
+        executor = self._get_executor()
+        try:
+            return executor.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            log.warning('Merge pool is broken, starting a new one')
+            if self._executor is executor:
+                self._executor = None
+            # Frees its management thread and pipes; its futures have already failed
+            executor.shutdown(wait=False, cancel_futures=True)
+            return self._get_executor().submit(func, *args, **kwargs)
+
+    def depth(self):
+        """Number of jobs queued or running in this process"""
+        with self._lock:
+            return len(self._pending)
+
+    def submit_merge(self, sources, output_path, download_url, total_pages=None, options=None,
+                     cache=None, cache_key=None, done=None):
+        """Queue a merge of sources (paths or MergeSpecs) and return its task id
+
+        done, if given, is called without arguments once the job has
+        finished, whatever its outcome.
+        """
+        task_id = str(uuid.uuid4())
+        filename = os.path.basename(output_path)
+        with self._lock:
+            if len(self._pending) >= self.max_depth:
+                raise QueueFull(f"Merge queue is full ({self.max_depth} jobs)")
+            write_status(self.status_folder, task_id, status='queued', progress=0,
+                         pages_merged=0, total_pages=total_pages, filename=filename)
+            try:
+                future = self._submit(run_merge_job, self.status_folder, task_id, sources,
+                                      output_path, download_url, total_pages, options,
+                                      cache, cache_key)
+            except Exception as e:
+                write_status(self.status_folder, task_id, status='failed', progress=0,
+                             filename=filename, message=str(e))
+                raise
+            self._pending.add(future)
+        input_names = [_source_name(source) for source in sources]
+        future.add_done_callback(lambda f: self._finished(task_id, f, filename, input_names, done))
+        return task_id
+
+    def submit_batch(self, outputs, options=None, cache=None, done=None):
+        """Queue the outputs of a batch merge, returns a task id per output
+
+        outputs are dicts with sources, output_path, download_url and
+        optionally total_pages and cache_key. They run as at most one job
+        per worker (see plan_batch); each output still gets its own status.
+        done is called once every job of the batch has finished. If a job
+        cannot be submitted, the outputs not yet queued are marked failed
+        and the error is raised.
+        """
+        groups = plan_batch(outputs, self.workers)
+        with self._lock:
+            if len(self._pending) + len(groups) > self.max_depth:
+                raise QueueFull(f"Merge queue is full ({self.max_depth} jobs)")
+            task_ids = []
+            for output in outputs:
+                output['task_id'] = str(uuid.uuid4())
+                task_ids.append(output['task_id'])
+                write_status(self.status_folder, output['task_id'], status='queued', progress=0,
+                             pages_merged=0, total_pages=output.get('total_pages'),
+                             filename=os.path.basename(output['output_path']))
+            futures = []
+            error = None
+            for n, group in enumerate(groups):
+                members = [outputs[i] for i in group]
+                try:
+                    future = self._submit(run_batch_job, self.status_folder,
+                                          members, options, cache)
+                except Exception as e:
+                    # Jobs already submitted run on; the rest of the batch fails
+                    error = e
+                    for output in (outputs[i] for rest in groups[n:] for i in rest):
+                        write_status(self.status_folder, output['task_id'], status='failed',
+                                     progress=0, message=str(e),
+                                     filename=os.path.basename(output['output_path']))
+                    break
+                self._pending.add(future)
+                futures.append((future, members))
+        remaining = [len(futures)]
+
+        def finished(future, members):
+            try:
+                self._batch_finished(future, members)
+            finally:
+                with self._lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and done is not None:
+                    done()
+
+        for future, members in futures:
+            future.add_done_callback(lambda f, members=members: finished(f, members))
+        if error is not None:
+            raise error
+        return task_ids
+
+    def run_merge(self, sources, output_path, options=None):
+        """Merge on a worker process and wait for it, returns the merge_pdfs result
+
+        Keeps a synchronous merge off the calling thread's core; it counts
+        against the queue depth like a queued job. Raises QueueFull, or
+        whatever merge_pdfs raised.
+        """
+        with self._lock:
+            if len(self._pending) >= self.max_depth:
+                raise QueueFull(f"Merge queue is full ({self.max_depth} jobs)")
+            future = self._submit(merge_pdfs, sources, output_path, **(options or {}))
+            self._pending.add(future)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._pending.discard(future)
+
+    def record_completed(self, output_path, download_url, result, sources=()):
+        """Create an already completed job, e.g. for a merge served from cache"""
+        task_id = str(uuid.uuid4())
+        state = completed_state(output_path, download_url, result)
+        write_status(self.status_folder, task_id, **state)
+        self._record_history(state, [_source_name(source) for source in sources])
+        metrics.record_merge('cached')
+        return task_id
+
+    def _finished(self, task_id, future, filename, input_names, done=None):
+        with self._lock:
+            self._pending.discard(future)
+        if done is not None:
+            done()
+        error = future.exception()
+        if error is not None:
+            # The worker died before it could record the failure itself
+            log.warning('Merge job %s crashed: %s', task_id, error)
+            write_status(self.status_folder, task_id, status='failed', progress=0,
+                         message=str(error))
+            state = {'status': 'failed', 'filename': filename}
+        else:
+            state = future.result()
+        self._record_history(state, input_names)
+        # Stage timings were measured in the worker, they are recorded here
+        if state['status'] == 'completed':
+            metrics.record_merge('queued', pages=state['pages_merged'], size=state['size'],
+                                 timings=state.get('timings'), errors=len(state['errors']))
+        else:
+            metrics.record_merge('queued', status='failed')
+
+    def _batch_finished(self, future, outputs):
+        with self._lock:
+            self._pending.discard(future)
+        error = future.exception()
+        if error is not None:
+            log.warning('Batch merge job crashed: %s', error)
+            states = []
+            for output in outputs:
+                # Outputs finished before the crash keep their status
+                state = read_status(self.status_folder, output['task_id']) or {}
+                if state.get('status') != 'completed':
+                    state = {'status': 'failed', 'progress': 0, 'message': str(error),
+                             'filename': os.path.basename(output['output_path'])}
+                    write_status(self.status_folder, output['task_id'], **state)
+                states.append(state)
+        else:
+            states = future.result()
+        for output, state in zip(outputs, states):
+            self._record_history(state, [_source_name(source) for source in output['sources']])
+            if state['status'] == 'completed':
+                metrics.record_merge('batch', pages=state['pages_merged'], size=state['size'],
+                                     timings=state.get('timings'), errors=len(state['errors']))
+            else:
+                metrics.record_merge('batch', status='failed')
+
+    def _record_history(self, state, input_names):
+        if self.history is None or not state.get('filename'):
+            return
+        try:
+            self.history.record(state['filename'], input_names,
+                                pages=state.get('pages_merged') or 0,
+                                size=state.get('size') or 0,
+                                status=state['status'], source='api')
+        except Exception as e:
+            log.warning('Could not record merge history: %s', e)
+
+    def status(self, task_id):
+        return read_status(self.status_folder, task_id)
@@ -0,0 +1,45 @@
+"""
+Read streams for PDF files on disk
+PyPDF2 given a path reads the whole file into a BytesIO, and a regular
+buffered file throws its buffer away on every seek, which the parser does
+for each object it looks up. Files of MMAP_THRESHOLD bytes and more are
+memory-mapped instead: seeks are free, a read copies only the bytes asked
+for, and the parts of the file the parser never touches (image data when
+only counting pages) are never read at all. Smaller files are read into
+memory in one call, which is the fastest way to parse them.
+
+Files are only ever replaced (os.replace) or removed while they may be
+open, never truncated in place, so a mapping cannot lose its pages.
+"""
+
+import mmap
+import os
+from io import BytesIO
+
+# Files of at least this many bytes are memory-mapped
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+
+def open_pdf_file(path, threshold=None):
+    """Binary stream (read, seek, tell, close) over the file at path
+
+    A read-only mmap for files of threshold (default MMAP_THRESHOLD) bytes
+    or more, otherwise a BytesIO of the contents.
+    """
+    threshold = MMAP_THRESHOLD if threshold is None else threshold
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0 or size < threshold:
+            return BytesIO(f.read())
+        # The mapping keeps its own reference to the file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def release(stream):
+    """Drop the pages of a mapped stream from this process's resident set
+
+    They stay in the page cache, so reading them again costs a minor page
+    fault. Does nothing for other streams.
+    """
+    if isinstance(stream, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED'):
+        stream.madvise(mmap.MADV_DONTNEED)
@@ -0,0 +1,751 @@
+"""
+PDF merge engine shared by the web routes and the background job workers
+
+Sources are copied into the output one at a time: each selected page and
+the objects it references are serialized and written out immediately, and
+the source file is closed before the next one is opened. Only the xref
+offsets and the page list stay in memory, so peak memory does not grow
+with the total page count.
+
+Each source can select and rotate pages; only the selected pages and the
+objects they reference are read and written. In interleave mode all
+sources are open at once and their pages are taken in turn (A1, B1, A2,
+B2, ...), e.g. to combine separately scanned front and back sides.
+
+With dedupe enabled, stream objects (fonts, images, ICC profiles, ...)
+are hashed after their references have been renumbered, and a stream that
+is byte-for-byte identical to one already written is pointed at that copy
+instead of being written again.
+
+Output profiles trade CPU for size. "lossless" Flate-compresses streams
+that were stored uncompressed and packs the non-stream objects into
+compressed object streams (with a cross-reference stream). "ebook" and
+"screen" also re-encode images as JPEG, downsampled to 150 or 72 dpi at
+the size of the page they are on; this needs Pillow and is skipped
+without it. Objects no page references are never copied in any profile.
+
+Linearized ("fast web view") output is produced by rewriting the finished
+file with qpdf, through pikepdf when it is installed or the qpdf command
+line tool otherwise.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import time
+import zlib
+from io import BytesIO
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject,
+                            NameObject, NullObject, NumberObject, StreamObject)
+
+from mapped_file import open_pdf_file, release
+
+try:
+    import pikepdf  # optional, used to linearize outputs
+except ImportError:
+    pikepdf = None
+
+try:
+    from PIL import Image  # optional, used to downsample images
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# Size of the chunks iter_merge hands out
+CHUNK_SIZE = 64 * 1024
+
+# Drop the reader's parsed-object cache once it holds this many objects
+RESOLVED_CACHE_LIMIT = 5000
+
+# Object numbers reserved for the page tree root and the catalog
+PAGES_OBJECT = 1
+CATALOG_OBJECT = 2
+
+# Objects packed into one object stream
+OBJECT_STREAM_SIZE = 100
+
+COMPRESSION_PROFILES = {
+    'none': {},
+    'lossless': {'compress_streams': True, 'object_streams': True},
+    'ebook': {'compress_streams': True, 'object_streams': True,
+              'image_dpi': 150, 'jpeg_quality': 75},
+    'screen': {'compress_streams': True, 'object_streams': True,
+               'image_dpi': 72, 'jpeg_quality': 50},
+}
+
+
+class MergeError(Exception):
+    """Raised when a merge produces no output"""
+
+
+class MergeSpec:
+    """One merge input: a PDF file, the pages to take from it and their rotation"""
+
+    def __init__(self, path, pages=None, rotate=0):
+        if int(rotate) % 90:
+            raise ValueError(f"Rotation must be a multiple of 90 degrees, not {rotate}")
+        self.path = path
+        self.pages = pages  # page range string like "1-3,7,10-"; None means all
+        self.rotate = int(rotate) % 360  # clockwise, added to each page's own rotation
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def page_indices(self, page_count):
+        """Zero-based page indices selected from a document of page_count pages"""
+        if not self.pages:
+            return list(range(page_count))
+        return parse_page_ranges(self.pages, page_count)
+
+
+def parse_page_ranges(text, page_count):
+    """Turn a 1-based range string like "1-3,7,10-" into zero-based indices"""
+    indices = []
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                start, _, stop = part.partition('-')
+                start = int(start) if start.strip() else 1
+                stop = int(stop) if stop.strip() else page_count
+            else:
+                start = stop = int(part)
+        except ValueError:
+            raise ValueError(f"Invalid page range: {part}") from None
+        if start < 1 or stop > page_count or start > stop:
+            raise ValueError(f"Page range {part} is outside 1-{page_count}")
+        indices.extend(range(start - 1, stop))
+    return indices
+
+
+class PdfStreamWriter:
+    """Writes a merged PDF object by object to a binary file"""
+
+    def __init__(self, output, dedupe=False, profile='none'):
+        if profile not in COMPRESSION_PROFILES:
+            raise ValueError(f"Unknown output profile: {profile}")
+        settings = COMPRESSION_PROFILES[profile]
+        self.output = output
+        self.dedupe = dedupe
+        self.compress_streams = settings.get('compress_streams', False)
+        self.object_streams = settings.get('object_streams', False)
+        self.image_dpi = settings.get('image_dpi') if Image is not None else None
+        self.jpeg_quality = settings.get('jpeg_quality')
+        self.position = 0
+        # Per object: file offset, or (object stream number, index) once packed
+        self.offsets = [None, None, None]  # object 0 is the free-list head
+        self.page_numbers = []
+        self.stream_digests = {}  # sha256 of a serialized stream -> object number
+        self.bytes_saved = 0
+        self.compression_saved = 0  # bytes the profile took off the output
+        self.compression_time = 0.0
+        self._packed = []  # (number, data) waiting for the current object stream
+        self._packed_number = None
+        self._write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.output.write(data)
+        self.position += len(data)
+
+    def allocate(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def write_object(self, number, data, packable=False):
+        """Write an object; packable (non-stream) objects may go into an object stream"""
+        if packable and self.object_streams:
+            if self._packed_number is None:
+                self._packed_number = self.allocate()
+            self.offsets[number] = (self._packed_number, len(self._packed))
+            self._packed.append((number, data))
+            if len(self._packed) >= OBJECT_STREAM_SIZE:
+                self._flush_packed()
+            return
+        self.offsets[number] = self.position
+        self._write(b'%d 0 obj\n' % number + data + b'\nendobj\n')
+
+    def _flush_packed(self):
+        """Write the pending objects as one compressed object stream"""
+        if not self._packed:
+            return
+        started = time.monotonic()
+        header = []
+        body = []
+        offset = 0
+        for number, data in self._packed:
+            header.append(b'%d %d' % (number, offset))
+            body.append(data)
+            offset += len(data) + 1
+        header = b' '.join(header) + b'\n'
+        content = header + b'\n'.join(body)
+        compressed = zlib.compress(content)
+        number = self._packed_number
+        data = (b'%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\n'
+                b'stream\n' % (number, len(self._packed), len(header), len(compressed))
+                + compressed + b'\nendstream\nendobj\n')
+        self.compression_time += time.monotonic() - started
+        # Compared with writing each object on its own
+        self.compression_saved += sum(len(b'%d 0 obj\n\nendobj\n' % packed) + len(packed_data)
+                                      for packed, packed_data in self._packed) - len(data)
+        self.offsets[number] = self.position
+        self._write(data)
+        self._packed = []
+        self._packed_number = None
+
+    def add_source(self, reader, page_indices, rotate=0):
+        """Copy the given pages of reader into the output, yielding after each page"""
+        copier = _SourceCopier(self, reader)
+        numbers = copier.reserve_pages(page_indices)
+        copied = []
+        try:
+            for index, number in zip(page_indices, numbers):
+                copier.copy_page(index, number, rotate)
+                self.page_numbers.append(number)
+                copied.append(number)
+                yield number
+        except Exception:
+            # Leave a failed source out of the page tree entirely (its pages
+            # may be interleaved with others); objects already written stay
+            # in the file unreferenced
+            dropped = set(copied)
+            self.page_numbers = [n for n in self.page_numbers if n not in dropped]
+            raise
+
+    def close(self):
+        """Write the page tree, catalog, xref table and trailer"""
+        kids = b' '.join(b'%d 0 R' % number for number in self.page_numbers)
+        self.write_object(PAGES_OBJECT, b'<< /Type /Pages /Kids [ %s ] /Count %d >>'
+                          % (kids, len(self.page_numbers)))
+        self.write_object(CATALOG_OBJECT, b'<< /Type /Catalog /Pages %d 0 R >>' % PAGES_OBJECT)
+        self._flush_packed()
+
+        # Numbers reserved for pages of a source that failed part way
+        for number, offset in enumerate(self.offsets):
+            if offset is None and number > 0:
+                self.write_object(number, b'null')
+
+        if self.object_streams:
+            self._write_xref_stream()
+            return
+
+        xref_position = self.position
+        lines = [b'xref\n0 %d\n' % len(self.offsets), b'0000000000 65535 f \n']
+        for offset in self.offsets[1:]:
+            lines.append(b'%010d 00000 n \n' % offset)
+        self._write(b''.join(lines))
+        self._write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (len(self.offsets), CATALOG_OBJECT, xref_position))
+
+    def _write_xref_stream(self):
+        """Cross-reference stream, needed to point into object streams"""
+        number = self.allocate()
+        xref_position = self.offsets[number] = self.position
+        width = max(4, (xref_position.bit_length() + 7) // 8)
+        rows = [b'\x00' + b'\x00' * width + b'\xff\xff']
+        for offset in self.offsets[1:]:
+            if isinstance(offset, tuple):
+                rows.append(b'\x02' + offset[0].to_bytes(width, 'big') + offset[1].to_bytes(2, 'big'))
+            else:
+                rows.append(b'\x01' + offset.to_bytes(width, 'big') + b'\x00\x00')
+        data = zlib.compress(b''.join(rows))
+        self._write(b'%d 0 obj\n<< /Type /XRef /Size %d /W [ 1 %d 2 ] /Root %d 0 R '
+                    b'/Filter /FlateDecode /Length %d >>\nstream\n'
+                    % (number, len(self.offsets), width, CATALOG_OBJECT, len(data))
+                    + data + b'\nendstream\nendobj\n')
+        self._write(b'startxref\n%d\n%%%%EOF\n' % xref_position)
+
+
+class _SourceCopier:
+    """Copies pages of one reader and everything they reference"""
+
+    def __init__(self, writer, reader):
+        self.writer = writer
+        self.reader = reader
+        self.numbers = {}     # (idnum, generation) in the source -> output number
+        self.visiting = set()
+        self.page_size = None  # of the page being copied, for image downsampling
+        # Page objects are only written through copy_page; references to
+        # pages that are not selected become null
+        self.page_refs = {}
+        for page in reader.pages:
+            ref = page.indirect_reference
+            if ref is not None:
+                self.page_refs[(ref.idnum, ref.generation)] = None
+
+    def reserve_pages(self, page_indices):
+        """Allocate output numbers for the selected pages up front so links
+        between them resolve regardless of copy order"""
+        numbers = []
+        for index in page_indices:
+            number = self.writer.allocate()
+            ref = self.reader.pages[index].indirect_reference
+            if ref is not None and self.page_refs.get((ref.idnum, ref.generation)) is None:
+                self.page_refs[(ref.idnum, ref.generation)] = number
+            numbers.append(number)
+        return numbers
+
+    def copy_page(self, index, number, rotate=0):
+        page = self.reader.pages[index]
+        box = page.mediabox
+        self.page_size = (float(box.width), float(box.height))
+        copy = DictionaryObject()
+        for key, value in page.items():
+            if key != '/Parent':
+                copy[NameObject(key)] = self.translate(value)
+        copy[NameObject('/Parent')] = IndirectObject(PAGES_OBJECT, 0, None)
+        if rotate:
+            copy[NameObject('/Rotate')] = NumberObject((page.rotation + rotate) % 360)
+        self.writer.write_object(number, self.serialize(copy), packable=True)
+
+        if len(self.reader.resolved_objects) > RESOLVED_CACHE_LIMIT:
+            self.reader.resolved_objects.clear()
+        # What was read for this page is copied, so peak RSS stays flat
+        release(self.reader.stream)
+
+    def copy_reference(self, ref):
+        """Output object number for a source reference, or None for null"""
+        key = (ref.idnum, ref.generation)
+        if key in self.page_refs:
+            return self.page_refs[key]
+        number = self.numbers.get(key)
+        if number is not None:
+            return number
+        if key in self.visiting:
+            # Reference cycle: reserve the number now, the object is written
+            # once the outer visit finishes
+            number = self.numbers[key] = self.writer.allocate()
+            return number
+
+        self.visiting.add(key)
+        try:
+            obj = ref.get_object()
+            data = self.serialize(self.translate_object(obj))
+        finally:
+            self.visiting.discard(key)
+
+        number = self.numbers.get(key)
+        digest = None
+        # Objects with a reserved number are already referenced by it
+        if number is None and self.writer.dedupe and isinstance(obj, StreamObject):
+            digest = hashlib.sha256(data).digest()
+            existing = self.writer.stream_digests.get(digest)
+            if existing is not None:
+                self.writer.bytes_saved += len(data)
+                self.numbers[key] = existing
+                return existing
+
+        if number is None:
+            number = self.writer.allocate()
+        self.numbers[key] = number
+        self.writer.write_object(number, data, packable=not isinstance(obj, StreamObject))
+        if digest is not None:
+            self.writer.stream_digests[digest] = number
+        if isinstance(obj, StreamObject):
+            # Stream data is most of a file's bytes and is copied only once;
+            # should another merge need it, it is read again from the file
+            self.reader.resolved_objects.pop((ref.generation, ref.idnum), None)
+        return number
+
+    def translate_object(self, obj):
+        """Copy of a top-level object with references renumbered"""
+        if isinstance(obj, StreamObject):
+            writer = self.writer
+            started = time.monotonic()
+            source = obj
+            if writer.image_dpi and self.page_size:
+                source = _downsample_image(obj, self.page_size, writer.image_dpi,
+                                           writer.jpeg_quality) or obj
+            data = source._data
+            compress = writer.compress_streams and '/Filter' not in source
+            if compress:
+                compressed = zlib.compress(data)
+                compress = len(compressed) < len(data)
+                if compress:
+                    data = compressed
+            writer.compression_saved += len(obj._data) - len(data)
+            writer.compression_time += time.monotonic() - started
+
+            copy = StreamObject()
+            for key, value in source.items():
+                if key != '/Length':
+                    copy[NameObject(key)] = self.translate(value)
+            if compress:
+                copy[NameObject('/Filter')] = NameObject('/FlateDecode')
+            copy._data = data
+            return copy
+        return self.translate(obj)
+
+    def translate(self, value):
+        if isinstance(value, IndirectObject):
+            number = self.copy_reference(value)
+            return NullObject() if number is None else IndirectObject(number, 0, None)
+        if isinstance(value, DictionaryObject):
+            copy = DictionaryObject()
+            for key, item in value.items():
+                copy[NameObject(key)] = self.translate(item)
+            return copy
+        if isinstance(value, ArrayObject):
+            return ArrayObject(self.translate(item) for item in value)
+        if value is None:
+            return NullObject()
+        return value
+
+    @staticmethod
+    def serialize(obj):
+        buffer = BytesIO()
+        obj.write_to_stream(buffer, None)
+        return buffer.getvalue()
+
+
+def _downsample_image(obj, page_size, dpi, quality):
+    """JPEG re-encoding of an image XObject scaled down to dpi, or None
+
+    Images are only ever scaled to fit the larger page dimension at dpi,
+    so nothing drawn on the page ends up below that resolution. Masks,
+    unusual color spaces and anything that would not get smaller are left
+    alone.
+    """
+    try:
+        if (obj.get('/Subtype') != '/Image' or obj.get('/ImageMask') or '/Decode' in obj
+                or '/Matte' in obj or obj.get('/BitsPerComponent') != 8):
+            return None
+        width, height = int(obj['/Width']), int(obj['/Height'])
+        scale = max(page_size) / 72 * dpi / max(width, height)
+        if scale > 0.9:
+            return None
+
+        colorspace = obj.get('/ColorSpace')
+        colorspace = colorspace.get_object() if colorspace is not None else None
+        if isinstance(colorspace, ArrayObject) and colorspace and colorspace[0] == '/ICCBased':
+            components = colorspace[1].get_object().get('/N')
+        else:
+            components = {'/DeviceGray': 1, '/DeviceRGB': 3}.get(colorspace)
+        mode = {1: 'L', 3: 'RGB'}.get(components)
+        if mode is None:
+            return None
+
+        filters = obj.get('/Filter')
+        filters = [] if filters is None else list(filters) if isinstance(filters, ArrayObject) else [filters]
+        if filters == ['/DCTDecode']:
+            image = Image.open(BytesIO(obj._data))
+            if image.mode != mode:
+                return None
+        elif filters in ([], ['/FlateDecode']):
+            image = Image.frombytes(mode, (width, height), obj.get_data())
+        else:
+            return None
+
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        buffer = BytesIO()
+        image.resize(size, Image.LANCZOS).save(buffer, 'JPEG', quality=quality, optimize=True)
+        if buffer.tell() >= len(obj._data):
+            return None
+    except Exception as e:
+        log.debug('Keeping image as is: %s', e)
+        return None
+
+    copy = StreamObject()
+    for key, value in obj.items():
+        if key not in ('/Length', '/Filter', '/DecodeParms', '/Width', '/Height'):
+            copy[NameObject(key)] = value
+    copy[NameObject('/Width')] = NumberObject(size[0])
+    copy[NameObject('/Height')] = NumberObject(size[1])
+    copy[NameObject('/Filter')] = NameObject('/DCTDecode')
+    copy._data = buffer.getvalue()
+    return copy
+
+
+def open_reader(path):
+    """Open a PdfReader, memory-mapping large files (see mapped_file)"""
+    stream = open_pdf_file(path)
+    try:
+        reader = PdfReader(stream, strict=False)
+        if reader.is_encrypted:
+            reader.decrypt('')
+    except Exception:
+        stream.close()
+        raise
+    return reader, stream
+
+
+def linearize_file(path):
+    """Rewrite path in place as a linearized PDF with hint tables
+
+    Returns False, leaving the file untouched, when neither pikepdf nor the
+    qpdf command is available.
+    """
+    tmp_path = f"{path}.lin"
+    try:
+        if pikepdf is not None:
+            with pikepdf.open(path) as pdf:
+                pdf.save(tmp_path, linearize=True)
+        elif shutil.which('qpdf'):
+            # Exit status 3 means qpdf succeeded with warnings
+            completed = subprocess.run(['qpdf', '--linearize', path, tmp_path],
+                                       capture_output=True)
+            if completed.returncode not in (0, 3):
+                raise MergeError(f"qpdf failed: {completed.stderr.decode(errors='replace').strip()}")
+        else:
+            return False
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+class ReaderCache:
+    """Readers kept open across several merges, e.g. the outputs of one batch job
+
+    uses maps input paths to the number of merges that will read them.
+    Only inputs used by more than one are kept open, so they are opened
+    and parsed once; objects their reader resolved stay cached for the next
+    merge (up to RESOLVED_CACHE_LIMIT), except streams, which are read
+    again. Call finished() after each merge so a reader is closed after its
+    last use instead of at the end of the job.
+    """
+
+    def __init__(self, uses):
+        self._uses = dict(uses)  # path -> merges still to read it
+        self._open = {}  # path -> (reader, file)
+
+    def open(self, path):
+        """(reader, file to close after the source); the file is None for shared readers"""
+        if self._uses.get(path, 0) <= 1 and path not in self._open:
+            return open_reader(path)
+        if path not in self._open:
+            self._open[path] = open_reader(path)
+        return self._open[path][0], None
+
+    def finished(self, paths):
+        """A merge that used paths is over; close the readers it was the last user of"""
+        for path in set(paths):
+            self._uses[path] = self._uses.get(path, 0) - 1
+            if self._uses[path] <= 0 and path in self._open:
+                self._open.pop(path)[1].close()
+
+    def close(self):
+        for _, stream in self._open.values():
+            stream.close()
+        self._open = {}
+
+
+def _open_source(spec, readers):
+    """(reader, file to close after the source) for a spec, from readers when given"""
+    if readers is not None:
+        return readers.open(spec.path)
+    return open_reader(spec.path)
+
+
+class _ChunkBuffer:
+    """Write target that collects output until it is handed on in chunks"""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def _close(stream):
+    if stream is not None:
+        stream.close()
+
+
+def _source_failed(result, spec, error, pages_counted):
+    log.warning('Error processing %s: %s', spec.name, error)
+    result['errors'].append({'name': spec.name, 'message': str(error)})
+    result['pages'] -= pages_counted
+
+
+def _copy_sequential(writer, specs, result, readers=None):
+    """Copy sources one after the other, yielding once per page"""
+    for spec in specs:
+        stream = None
+        copied = 0
+        try:
+            started = time.perf_counter()
+            try:
+                reader, stream = _open_source(spec, readers)
+            finally:
+                result['timings']['reader_open'] += time.perf_counter() - started
+            indices = spec.page_indices(len(reader.pages))
+            if not indices:
+                log.debug('Skipping empty PDF: %s', spec.name)
+                continue
+            for _ in writer.add_source(reader, indices, spec.rotate):
+                copied += 1
+                yield
+        except Exception as e:
+            _source_failed(result, spec, e, copied)
+        finally:
+            # Release the source before touching the next one
+            if stream is not None:
+                stream.close()
+            reader = None
+
+
+def _copy_interleaved(writer, specs, result, readers=None):
+    """Copy one page of each source in turn, yielding once per page"""
+    sources = []  # [spec, file (None if shared), page generator, pages copied]
+    try:
+        for spec in specs:
+            started = time.perf_counter()
+            try:
+                reader, stream = _open_source(spec, readers)
+            except Exception as e:
+                _source_failed(result, spec, e, 0)
+                continue
+            finally:
+                result['timings']['reader_open'] += time.perf_counter() - started
+            try:
+                indices = spec.page_indices(len(reader.pages))
+            except Exception as e:
+                _close(stream)
+                _source_failed(result, spec, e, 0)
+                continue
+            if not indices:
+                log.debug('Skipping empty PDF: %s', spec.name)
+                _close(stream)
+                continue
+            sources.append([spec, stream, writer.add_source(reader, indices, spec.rotate), 0])
+
+        while sources:
+            for source in list(sources):
+                spec, stream, pages, copied = source
+                try:
+                    next(pages)
+                except StopIteration:
+                    sources.remove(source)
+                    _close(stream)
+                    continue
+                except Exception as e:
+                    sources.remove(source)
+                    _close(stream)
+                    _source_failed(result, spec, e, copied)
+                    continue
+                source[3] += 1
+                yield
+    finally:
+        for source in sources:
+            _close(source[1])
+
+
+def iter_merge(sources, result, progress=None, total_pages=None, dedupe=False,
+               interleave=False, profile='none', readers=None):
+    """Merge sources (paths or MergeSpecs, in order), yielding the output bytes
+
+    Output is yielded in chunks of roughly CHUNK_SIZE bytes as pages are
+    copied, so it can go straight to a file or an HTTP response. result is
+    a dict that gets the page count, bytes saved by dedupe and per-file
+    errors. progress, if given, is called as progress(pages_merged, total_pages).
+    With interleave, pages are taken from each source in turn instead of
+    one source after the other. profile is one of COMPRESSION_PROFILES;
+    result also gets the bytes it saved and the seconds it took, and
+    'timings' the seconds spent opening readers and copying pages. With
+    readers (a ReaderCache) sources are opened through it, and those it
+    shares are left open for later merges. Raises
+    MergeError (after the header has been produced) if no pages could be
+    merged.
+    """
+    specs = [s if isinstance(s, MergeSpec) else MergeSpec(s) for s in sources]
+    result.update(pages=0, bytes_saved=0, errors=[], compression_saved=0, compression_seconds=0.0,
+                  timings={'reader_open': 0.0, 'page_copy': 0.0})
+    buffer = _ChunkBuffer()
+    writer = PdfStreamWriter(buffer, dedupe=dedupe, profile=profile)
+
+    # Time spent here rather than in the consumer of the chunks
+    working = 0.0
+    started = time.perf_counter()
+    copy_pages = _copy_interleaved if interleave else _copy_sequential
+    for _ in copy_pages(writer, specs, result, readers):
+        result['pages'] += 1
+        if progress:
+            progress(result['pages'], total_pages)
+        if buffer.size >= CHUNK_SIZE:
+            working += time.perf_counter() - started
+            yield buffer.take()
+            started = time.perf_counter()
+
+    if result['pages'] == 0:
+        raise MergeError('No valid pages found to merge')
+    writer.close()
+    working += time.perf_counter() - started
+    result['bytes_saved'] = writer.bytes_saved
+    result['compression_saved'] = writer.compression_saved
+    result['compression_seconds'] = round(writer.compression_time, 3)
+    result['timings']['page_copy'] = working - result['timings']['reader_open']
+    yield buffer.take()
+
+
+def merge_pdfs(sources, output_path, progress=None, total_pages=None, dedupe=False,
+               linearize=False, interleave=False, profile='none', readers=None, keep_path=None):
+    """Merge the given sources (paths or MergeSpecs, in order) into output_path
+
+    progress, if given, is called as progress(pages_merged, total_pages);
+    total_pages is None unless the caller passed it in. interleave,
+    profile and readers are as for iter_merge. keep_path, if given, gets
+    a link to (or copy of) the finished output made before it is moved
+    into place: output_path may be a shared name another merge replaces
+    at any time, keep_path is this merge's own.
+    Returns a dict with the page count, the bytes saved by dedupe, whether
+    the output is linearized, a list of per-file errors, the output size
+    without the profile and the final size after the profile and
+    linearization, with the seconds the merge and the profile took.
+    """
+    result = {}
+    started = time.monotonic()
+    writing = 0.0
+    tmp_path = f"{output_path}.{os.getpid()}.part"
+    try:
+        with open(tmp_path, 'wb') as output_file:
+            for chunk in iter_merge(sources, result, progress, total_pages, dedupe, interleave,
+                                    profile, readers):
+                write_started = time.perf_counter()
+                output_file.write(chunk)
+                writing += time.perf_counter() - write_started
+        # Before any post-processing: what the merge would have been without the profile
+        size_before = os.path.getsize(tmp_path) + result['compression_saved']
+        write_started = time.perf_counter()
+        linearized = linearize and linearize_file(tmp_path)
+        writing += time.perf_counter() - write_started
+        if linearize and not linearized:
+            log.debug('Linearization requested but neither pikepdf nor qpdf is available')
+        size = os.path.getsize(tmp_path)
+        if keep_path is not None:
+            try:
+                os.link(tmp_path, keep_path)
+            except OSError:
+                shutil.copyfile(tmp_path, keep_path)
+        try:
+            os.replace(tmp_path, output_path)
+        except OSError:
+            if keep_path is not None and os.path.exists(keep_path):
+                os.remove(keep_path)
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    result['linearized'] = bool(linearized)
+    result['size_after'] = size
+    result['size_before'] = size_before
+    result['seconds'] = round(time.monotonic() - started, 3)
+    result['timings']['output_write'] = writing
+    return result
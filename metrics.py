@@ -0,0 +1,245 @@
+"""
+Prometheus-style metrics and logging setup
+Counters, gauges and histograms are kept in memory and rendered in the
+Prometheus text format by /metrics. Each server process has its own
+values, so with several gunicorn workers every worker is a separate
+target. Merges that run in worker processes report their stage timings
+in their result; the process that queued them records those here.
+
+Logging goes through the standard logging module. LOG_LEVEL (default
+WARNING) picks the level and LOG_FORMAT=json writes one JSON object per
+line; messages below the level are never formatted.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a fast metadata lookup to a huge merge
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value (or histogram state)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels(self.labelnames, key, [('le', _format_value(bound))])}"
+                             f" {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """The metrics of one process, in registration order"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, func):
+        """Call func() before each render, e.g. to set gauges read from elsewhere"""
+        self._collectors.append(func)
+
+    def render(self):
+        for func in self._collectors:
+            try:
+                func()
+            except Exception as e:
+                logging.getLogger(__name__).warning('Metrics collector failed: %s', e)
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'pdfmerge_requests_total', 'HTTP requests by endpoint and status code', ['endpoint', 'status']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'pdfmerge_request_seconds', 'Time to produce a response (streamed bodies excluded)', ['endpoint']))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'pdfmerge_requests_in_flight', 'Requests being handled'))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'pdfmerge_stage_seconds', 'Time spent in each processing stage', ['stage']))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge(
+    'pdfmerge_stage_in_flight', 'Operations currently in each stage of this process', ['stage']))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'pdfmerge_stage_errors_total', 'Failures by processing stage', ['stage']))
+BYTES = REGISTRY.register(Counter(
+    'pdfmerge_bytes_total', 'Bytes uploaded, merged and downloaded', ['direction']))
+PAGES = REGISTRY.register(Counter(
+    'pdfmerge_pages_merged_total', 'Pages written to merged PDFs'))
+MERGES = REGISTRY.register(Counter(
+    'pdfmerge_merges_total', 'Merges by mode and outcome', ['mode', 'status']))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'pdfmerge_merge_queue_depth', 'Merge jobs queued or running in this process'))
+MERGES_IN_FLIGHT = REGISTRY.register(Gauge(
+    'pdfmerge_merges_in_flight', 'Admitted merges of all server processes that have not finished'))
+MERGE_COST_IN_FLIGHT = REGISTRY.register(Gauge(
+    'pdfmerge_merge_cost_in_flight', 'Estimated cost (pages + input MB) of the merges in flight'))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    'pdfmerge_admission_rejected_total', 'Merges turned away before running', ['reason']))
+
+for _stage in ('upload_save', 'pdf_info', 'reader_open', 'page_copy', 'output_write', 'send_file'):
+    STAGE_IN_FLIGHT.set(0, stage=_stage)
+REQUESTS_IN_FLIGHT.set(0)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one observation of a stage, counting it in flight and on failure"""
+    STAGE_IN_FLIGHT.inc(stage=name)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+        STAGE_IN_FLIGHT.dec(stage=name)
+
+
+def record_merge(mode, status='completed', pages=0, size=0, timings=None, errors=0):
+    """Record a finished merge; timings are the stage seconds from its result"""
+    for name, seconds in (timings or {}).items():
+        STAGE_SECONDS.observe(seconds, stage=name)
+    PAGES.inc(pages)
+    BYTES.inc(size, direction='merged')
+    if errors:
+        STAGE_ERRORS.inc(errors, stage='page_copy')
+    MERGES.inc(mode=mode, status=status)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; extra= fields become keys"""
+
+    _standard = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in self._standard:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=None, fmt=None):
+    """Set up the root logger from LOG_LEVEL / LOG_FORMAT unless already configured"""
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    level = (level or os.environ.get('LOG_LEVEL', 'WARNING')).upper()
+    handler = logging.StreamHandler(sys.stderr)
+    if (fmt or os.environ.get('LOG_FORMAT', 'text')) == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(level)
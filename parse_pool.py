@@ -0,0 +1,71 @@
+"""
+Shared process pool for CPU-bound PDF parsing
+PyPDF2 is pure Python, so parsing a batch of files in the request thread
+uses a single core. Batches are fanned out over a bounded pool shared by
+all requests; each file gets its own time limit, enforced inside the
+worker, so a pathological PDF fails alone without wedging a worker.
+"""
+
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ParseTimeout(Exception):
+    """Raised when parsing a single file takes longer than allowed"""
+
+
+def _call_with_timeout(func, arg, timeout):
+    """Run func(arg) in a pool worker, interrupting it after timeout seconds"""
+    def on_alarm(signum, frame):
+        raise ParseTimeout(f"Parsing took longer than {timeout}s")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(arg)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class ParsePool:
+    """Bounded process pool that maps a function over a batch in order"""
+
+    def __init__(self, workers=2, timeout=30):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def map(self, func, items):
+        """Apply func to every item in parallel
+
+        Returns a list in the order of items holding either the result or
+        the exception raised for that item.
+        """
+        if not items:
+            return []
+        executor = self._get_executor()
+        futures = [executor.submit(_call_with_timeout, func, item, self.timeout)
+                   for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BrokenProcessPool as e:
+                # A worker died (e.g. out of memory); start a fresh pool next time
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                results.append(e)
+            except Exception as e:
+                results.append(e)
+        return results
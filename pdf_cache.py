@@ -0,0 +1,174 @@
+"""
+Content-addressed PDF metadata cache
+Entries are keyed by the SHA-256 of the file contents and persisted in a
+small SQLite database with LRU eviction, so a file that has been seen
+before never has to be parsed with PyPDF2 again
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+from PyPDF2 import PdfReader
+
+from mapped_file import open_pdf_file
+from pdf_inspect import InspectError, inspect_pdf
+
+log = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# Don't rewrite last_used on every hit, only when it is older than this
+TOUCH_INTERVAL = 60
+
+
+def file_sha256(filepath):
+    """SHA-256 hex digest of a file on disk"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_pdf_info(filepath):
+    """Collect the metadata that gets cached
+
+    The page count comes from the root of the page tree (pdf_inspect);
+    encrypted and damaged files get a full parse instead. Only the full
+    parse has page_sizes; PdfInfoCache.page_sizes() fills them in later.
+    """
+    try:
+        return inspect_pdf(filepath)
+    except InspectError as e:
+        log.debug('Full parse of %s: %s', filepath, e)
+        return parse_pdf_info(filepath)
+
+
+def parse_pdf_info(filepath):
+    """read_pdf_info with PyPDF2, walking the whole page tree
+
+    Also reads the width and height of every page, in points.
+    """
+    with closing(open_pdf_file(filepath)) as stream:
+        reader = PdfReader(stream, strict=False)
+        encrypted = reader.is_encrypted
+        if encrypted:
+            reader.decrypt('')
+        page_sizes = []
+        for page in reader.pages:
+            box = page.mediabox
+            page_sizes.append([float(box.width), float(box.height)])
+        version = reader.pdf_header.replace('%PDF-', '')
+    return {
+        'pages': len(page_sizes),
+        'size': os.path.getsize(filepath),
+        'version': version,
+        'encrypted': encrypted,
+        'page_sizes': page_sizes,
+    }
+
+
+class PdfInfoCache:
+    """SQLite-backed LRU cache of PDF metadata with an in-memory front"""
+
+    def __init__(self, db_path, max_entries=10000, memory_entries=1024):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS pdf_info ('
+                         'sha256 TEXT PRIMARY KEY, info TEXT NOT NULL, last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pdf_info_last_used ON pdf_info (last_used)')
+
+    def _connect(self):
+        # A connection per call keeps the cache safe across threads and forks
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _remember(self, digest, info, touched):
+        with self._lock:
+            self._memory[digest] = (info, touched)
+            self._memory.move_to_end(digest)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, digest):
+        """Cached info for a content hash, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(digest)
+            if entry is not None:
+                self._memory.move_to_end(digest)
+        if entry is not None and now - entry[1] < TOUCH_INTERVAL:
+            return entry[0]
+
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute('SELECT info FROM pdf_info WHERE sha256 = ?', (digest,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE pdf_info SET last_used = ? WHERE sha256 = ?', (now, digest))
+        info = json.loads(row[0])
+        self._remember(digest, info, now)
+        return info
+
+    def put(self, digest, info):
+        """Store info for a content hash, evicting the least recently used entries"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO pdf_info (sha256, info, last_used) VALUES (?, ?, ?)',
+                         (digest, json.dumps(info), now))
+            conn.execute('DELETE FROM pdf_info WHERE sha256 IN ('
+                         'SELECT sha256 FROM pdf_info ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                         (self.max_entries,))
+        self._remember(digest, info, now)
+
+    def lookup_many(self, items, pool):
+        """Metadata for a batch of (filepath, digest) pairs, parsing misses on pool
+
+        Returns results in order; a file that could not be read gives the
+        exception instead of an info dict.
+        """
+        results = []
+        misses = []
+        for filepath, digest in items:
+            try:
+                if digest is None:
+                    digest = file_sha256(filepath)
+                info = self.get(digest)
+            except Exception as e:
+                results.append(e)
+                continue
+            if info is None:
+                misses.append((len(results), filepath, digest))
+            results.append(None if info is None else dict(info, sha256=digest))
+
+        parsed = pool.map(read_pdf_info, [filepath for _, filepath, _ in misses])
+        for (index, _, digest), info in zip(misses, parsed):
+            if not isinstance(info, Exception):
+                self.put(digest, info)
+                info = dict(info, sha256=digest)
+            results[index] = info
+        return results
+
+    def page_sizes(self, filepath, digest=None):
+        """[width, height] of every page of a file, in points
+
+        Info from the fast path has no page sizes; the first call parses
+        the file fully and stores them with the rest of its info.
+        """
+        if digest is None:
+            digest = file_sha256(filepath)
+        info = self.get(digest)
+        if info is None or 'page_sizes' not in info:
+            info = dict(info or {}, **parse_pdf_info(filepath))
+            self.put(digest, info)
+        return info['page_sizes']
@@ -0,0 +1,210 @@
+"""
+Fast PDF inspection
+Reads the page count, version and encryption of a PDF from its header,
+its trailer, the cross-reference sections (tables or streams, following
+/Prev through incremental updates) and the /Count of the root page tree
+node, without building a PdfReader or walking the page tree. That is a
+few KB of reads whatever the size of the file. Anything unexpected raises
+InspectError, and the caller falls back to a full parse, which can also
+recover damaged files.
+"""
+
+import os
+import re
+from io import BytesIO
+
+from PyPDF2.generic import DictionaryObject, IndirectObject, StreamObject, read_object
+
+# Same header and trailer windows as the upload check
+from ingest import HEADER_RE, HEADER_WINDOW, TAIL_WINDOW
+
+# Cross-reference sections followed through /Prev before giving up
+MAX_SECTIONS = 64
+# Xref tables have fixed-size entries
+ENTRY_SIZE = 20
+
+_STARTXREF_RE = re.compile(rb'startxref\s+(\d+)')
+_SUBSECTION_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s*')
+_TRAILER_RE = re.compile(rb'\s*trailer\s*')
+_ENTRY_RE = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+_OBJECT_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\s*')
+_COMMENT_RE = re.compile(rb'%[^\r\n]*')
+
+
+class InspectError(Exception):
+    """Raised when a file cannot be inspected without a full parse"""
+
+
+def inspect_pdf(filepath):
+    """Page count, size, version and encryption of a PDF; raises InspectError
+
+    Encrypted files raise too: whether their pages can be read at all is
+    only known after trying to decrypt them.
+    """
+    with open(filepath, 'rb') as f:
+        try:
+            return _Inspector(f).info()
+        except InspectError:
+            raise
+        except Exception as e:
+            raise InspectError(str(e) or type(e).__name__) from e
+
+
+class _Inspector:
+    def __init__(self, f):
+        self.f = f
+        self.size = os.fstat(f.fileno()).st_size
+        self.sections = []       # newest first
+        self.object_streams = {}  # object number -> (decoded data, offset of first object)
+
+    def _read(self, position, length):
+        self.f.seek(position)
+        return self.f.read(length)
+
+    def info(self):
+        header = HEADER_RE.search(self._read(0, HEADER_WINDOW))
+        if header is None:
+            raise InspectError('Missing %PDF- header')
+        starts = _STARTXREF_RE.findall(self._read(max(0, self.size - TAIL_WINDOW), TAIL_WINDOW))
+        if not starts:
+            raise InspectError('Missing startxref')
+        self._load_sections(int(starts[-1]))
+
+        trailer = self.sections[0]['trailer']
+        if '/Encrypt' in trailer:
+            raise InspectError('Encrypted')
+        catalog = self._resolve(trailer.get('/Root'))
+        pages = self._resolve(catalog.get('/Pages')) if isinstance(catalog, DictionaryObject) else None
+        count = self._resolve(pages.get('/Count')) if isinstance(pages, DictionaryObject) else None
+        if not isinstance(count, int) or count < 0:
+            raise InspectError('No page count in the root page tree node')
+        return {
+            'pages': int(count),
+            'size': self.size,
+            'version': header.group(1).decode(),
+            'encrypted': False,
+        }
+
+    def _load_sections(self, offset):
+        seen = set()
+        while offset is not None:
+            if offset in seen or len(seen) >= MAX_SECTIONS or not 0 <= offset < self.size:
+                raise InspectError(f"Bad cross-reference offset {offset}")
+            seen.add(offset)
+            if self._read(offset, 4) == b'xref':
+                section = self._read_table(offset)
+                self.sections.append(section)
+                if '/XRefStm' in section['trailer']:
+                    # Hybrid file: objects the table lists as free may be in the stream
+                    self.sections.append(self._read_stream_section(int(section['trailer']['/XRefStm'])))
+            else:
+                section = self._read_stream_section(offset)
+                self.sections.append(section)
+            prev = section['trailer'].get('/Prev')
+            offset = int(prev) if prev is not None else None
+
+    def _read_table(self, offset):
+        """A classic xref table; its entries are only read when looked up"""
+        position = offset + 4
+        subsections = []
+        while True:
+            chunk = self._read(position, 64)
+            match = _SUBSECTION_RE.match(chunk)
+            if match is None:
+                match = _TRAILER_RE.match(chunk)
+                if match is None:
+                    raise InspectError(f"Bad xref table at {offset}")
+                trailer = self._read_object(position + match.end())
+                break
+            start, count = int(match.group(1)), int(match.group(2))
+            data = position + match.end()
+            subsections.append((start, count, data))
+            position = data + count * ENTRY_SIZE
+            if position > self.size:
+                raise InspectError(f"Xref table at {offset} runs past the end of the file")
+        if not isinstance(trailer, DictionaryObject):
+            raise InspectError(f"Bad trailer at {offset}")
+        return {'subsections': subsections, 'trailer': trailer}
+
+    def _read_stream_section(self, offset):
+        """A cross-reference stream; like tables, only looked-up rows are decoded"""
+        stream = self._read_indirect(offset)
+        if not isinstance(stream, StreamObject) or stream.get('/Type') != '/XRef':
+            raise InspectError(f"No cross-reference stream at {offset}")
+        widths = [int(width) for width in stream['/W']]
+        index = [int(value) for value in stream.get('/Index', [0, stream['/Size']])]
+        data = stream.get_data()
+        row_size = sum(widths)
+        subsections = []
+        position = 0
+        for start, count in zip(index[::2], index[1::2]):
+            subsections.append((start, count, position))
+            position += count * row_size
+        if position > len(data):
+            raise InspectError(f"Short cross-reference stream at {offset}")
+        return {'subsections': subsections, 'rows': data, 'widths': widths, 'trailer': stream}
+
+    def _lookup(self, number):
+        """(1, offset) or (2, object stream number) of an object, newest section first"""
+        for section in self.sections:
+            for start, count, position in section['subsections']:
+                if not start <= number < start + count:
+                    continue
+                if 'rows' in section:
+                    entry = _stream_entry(section, position, number - start)
+                    if entry[0] in (1, 2):
+                        return entry
+                    continue
+                match = _ENTRY_RE.match(self._read(position + (number - start) * ENTRY_SIZE,
+                                                   ENTRY_SIZE))
+                if match is None:
+                    raise InspectError(f"Bad xref entry for object {number}")
+                if match.group(3) == b'n':
+                    return 1, int(match.group(1))
+        raise InspectError(f"Object {number} is not in the cross-reference table")
+
+    def _resolve(self, value):
+        if not isinstance(value, IndirectObject):
+            return value
+        kind, location = self._lookup(value.idnum)
+        if kind == 1:
+            return self._read_indirect(location, value.idnum)
+        return self._read_compressed(value.idnum, location)
+
+    def _read_object(self, position):
+        self.f.seek(position)
+        return read_object(self.f, None)
+
+    def _read_indirect(self, offset, number=None):
+        match = _OBJECT_RE.match(self._read(offset, 64))
+        if match is None or (number is not None and int(match.group(1)) != number):
+            raise InspectError(f"No object {number if number is not None else ''} at {offset}")
+        return self._read_object(offset + match.end())
+
+    def _read_compressed(self, number, stream_number):
+        if stream_number not in self.object_streams:
+            kind, offset = self._lookup(stream_number)
+            stream = self._read_indirect(offset, stream_number) if kind == 1 else None
+            if not isinstance(stream, StreamObject) or stream.get('/Type') != '/ObjStm':
+                raise InspectError(f"Object {stream_number} is not an object stream")
+            self.object_streams[stream_number] = (stream.get_data(), int(stream['/First']))
+        data, first = self.object_streams[stream_number]
+        pairs = [int(value) for value in _COMMENT_RE.sub(b'', data[:first]).split()]
+        for object_number, object_offset in zip(pairs[::2], pairs[1::2]):
+            if object_number == number:
+                stream = BytesIO(data)
+                stream.seek(first + object_offset)
+                return read_object(stream, None)
+        raise InspectError(f"Object {number} is not in object stream {stream_number}")
+
+
+def _stream_entry(section, position, row):
+    """(type, second field) of a row of a cross-reference stream"""
+    widths = section['widths']
+    start = position + row * sum(widths)
+    fields = []
+    for width in widths[:2]:
+        fields.append(int.from_bytes(section['rows'][start:start + width], 'big'))
+        start += width
+    # A zero-width type field means type 1
+    return fields[0] if widths[0] else 1, fields[1]
@@ -0,0 +1,124 @@
+"""
+Merge result cache
+A merge is identified by the ordered content hashes of its inputs plus the
+merge options. Finished outputs are hard-linked into a cache folder inside
+OUTPUT_FOLDER, so a repeated merge is answered by linking the existing file
+to the new output name instead of merging again. With an expiry index,
+cached files age out like the other outputs; entries whose file has gone
+are treated as misses. The cache is also bounded by total size (LRU).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+
+
+def merge_key(input_digests, options):
+    """Cache key for an ordered list of input hashes and the merge options"""
+    payload = json.dumps({'inputs': list(input_digests), 'options': options},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def link_or_copy(src, dest):
+    """Atomically make dest the same file as src, copying if linking fails"""
+    tmp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+class MergeResultCache:
+    """SQLite index of cached merge outputs, bounded by total bytes"""
+
+    def __init__(self, db_path, folder, max_bytes=1024 * 1024 * 1024, expiry=None, ttl=48 * 3600):
+        self.db_path = db_path
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        os.makedirs(folder, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS merge_results ('
+                         'key TEXT PRIMARY KEY, result TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS merge_results_last_used '
+                         'ON merge_results (last_used)')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.pdf")
+
+    def get(self, key, output_path):
+        """On a hit, link the cached output to output_path and return its merge result"""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute('SELECT result FROM merge_results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                link_or_copy(self._path(key), output_path)
+                # Links share one mtime; refresh it so the expiry sweep doesn't
+                # purge a just-served output because the cached copy is old
+                os.utime(output_path)
+            except OSError:
+                # Purged by cleanup.py (or by hand) since it was cached
+                conn.execute('DELETE FROM merge_results WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE merge_results SET last_used = ? WHERE key = ?',
+                         (time.time(), key))
+        return json.loads(row[0])
+
+    def staging_path(self, key):
+        """A private path to pass to merge_pdfs as keep_path, then to put()"""
+        os.makedirs(self.folder, exist_ok=True)
+        return f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+
+    def put(self, key, path, result):
+        """Remember a finished merge output under key
+
+        path must be the merge's own copy of the output (see staging_path),
+        never the output name: that can be shared by other merges, which may
+        have replaced the file since. The cache takes the file over.
+        """
+        size = os.path.getsize(path)
+        os.replace(path, self._path(key))
+        if self.expiry is not None:
+            self.expiry.schedule(self._path(key), self.ttl, kind='cache')
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO merge_results (key, result, size, last_used) '
+                         'VALUES (?, ?, ?, ?)', (key, json.dumps(result), size, time.time()))
+            self._evict(conn)
+
+    @staticmethod
+    def discard(path):
+        """Remove a staging file that was not put()"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM merge_results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM merge_results '
+                                      'ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM merge_results WHERE key = ?', (key,))
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total -= size
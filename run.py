@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """
 Production runner for PDF Merger Flask app
+SERVER_MODE=asgi serves it through asgi.py with uvicorn instead of the
+threaded WSGI server.
 """
 
 from app import app
@@ -10,10 +12,17 @@ if __name__ == '__main__':
     # Get port from environment variable or default to 5000
     port = int(os.environ.get('PORT', 5000))
     
-    # Run in production mode
-    app.run(
-        host='0.0.0.0',
-        port=port,
-        debug=False,
-        threaded=True
-    )
\ No newline at end of file
+    if os.environ.get('SERVER_MODE', 'wsgi') == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            raise SystemExit('SERVER_MODE=asgi needs uvicorn: pip install uvicorn')
+        uvicorn.run('asgi:app', host='0.0.0.0', port=port)
+    else:
+        # Run in production mode
+        app.run(
+            host='0.0.0.0',
+            port=port,
+            debug=False,
+            threaded=True
+        )
@@ -0,0 +1,133 @@
+"""
+Server-side storage for upload session manifests
+The browser cookie only carries the upload_id; the file list, merge order
+and merge result of an upload live here. Two backends are provided: an
+embedded SQLite store shared by all worker processes, and an in-process
+LRU store for single-process deployments and development.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+
+class SessionStore:
+    """Interface for manifest storage keyed by upload_id"""
+
+    def get(self, upload_id):
+        """The manifest dict for upload_id, or None"""
+        raise NotImplementedError
+
+    def set(self, upload_id, manifest):
+        raise NotImplementedError
+
+    def touch(self, upload_id):
+        """Mark a manifest as used now without changing it"""
+        raise NotImplementedError
+
+    def delete(self, upload_id):
+        raise NotImplementedError
+
+    def purge(self, max_age):
+        """Drop manifests not updated for max_age seconds, returns how many"""
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """In-process LRU store; not shared between worker processes"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, upload_id):
+        with self._lock:
+            entry = self._data.get(upload_id)
+            if entry is None:
+                return None
+            self._data.move_to_end(upload_id)
+            # Hand out a copy so callers can't change the stored manifest in place
+            return json.loads(entry[0])
+
+    def set(self, upload_id, manifest):
+        with self._lock:
+            self._data[upload_id] = (json.dumps(manifest), time.time())
+            self._data.move_to_end(upload_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def touch(self, upload_id):
+        with self._lock:
+            entry = self._data.get(upload_id)
+            if entry is not None:
+                self._data[upload_id] = (entry[0], time.time())
+                self._data.move_to_end(upload_id)
+
+    def delete(self, upload_id):
+        with self._lock:
+            self._data.pop(upload_id, None)
+
+    def purge(self, max_age):
+        cutoff = time.time() - max_age
+        with self._lock:
+            expired = [key for key, (_, updated) in self._data.items() if updated < cutoff]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store backed by an embedded SQLite database"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS upload_sessions ('
+                         'upload_id TEXT PRIMARY KEY, manifest TEXT NOT NULL, updated REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS upload_sessions_updated '
+                         'ON upload_sessions (updated)')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def get(self, upload_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT manifest FROM upload_sessions WHERE upload_id = ?',
+                               (upload_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, upload_id, manifest):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO upload_sessions (upload_id, manifest, updated) '
+                         'VALUES (?, ?, ?)', (upload_id, json.dumps(manifest), time.time()))
+
+    def touch(self, upload_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('UPDATE upload_sessions SET updated = ? WHERE upload_id = ?',
+                         (time.time(), upload_id))
+
+    def delete(self, upload_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (upload_id,))
+
+    def purge(self, max_age):
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute('DELETE FROM upload_sessions WHERE updated < ?',
+                                  (time.time() - max_age,))
+        return cursor.rowcount
+
+
+def create_session_store(backend, data_folder):
+    """Build the store named by backend ('sqlite' or 'memory')"""
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'sqlite':
+        return SQLiteSessionStore(os.path.join(data_folder, 'sessions.sqlite3'))
+    raise ValueError(f"Unknown session store backend: {backend}")
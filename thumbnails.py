@@ -0,0 +1,139 @@
+"""
+Page thumbnails for the merge and reorder pages
+A thumbnail is a small PNG of one page, stored on disk under the content
+hash of its PDF, the page number and the width, so each is rendered once
+however many sessions upload the same file. Renders run on their own
+bounded process pool; concurrent requests for the same thumbnail wait for
+a single render. Uploads queue their first pages in the background so the
+merge page usually finds them ready.
+
+Rendering needs PyMuPDF (pip install pymupdf). Without it, thumbnails are
+unavailable and the pages fall back to the plain file icon.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pymupdf  # optional
+except ImportError:
+    try:
+        import fitz as pymupdf  # PyMuPDF before 1.24.3
+    except ImportError:
+        pymupdf = None
+
+log = logging.getLogger(__name__)
+
+
+def renderer_available():
+    return pymupdf is not None
+
+
+def render_thumbnail(job):
+    """Render page page_index of path as a PNG width pixels wide at dest
+
+    job is a (path, page_index, dest, width) tuple so it can go through
+    ParsePool.map.
+    """
+    path, page_index, dest, width = job
+    tmp_path = f"{dest}.{os.getpid()}.tmp"
+    try:
+        with pymupdf.open(path) as doc:
+            page = doc[page_index]
+            zoom = width / page.rect.width
+            page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).save(tmp_path, output='png')
+        os.replace(tmp_path, dest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dest
+
+
+def _touch(path):
+    """Mark an existing thumbnail as used, False if there is none
+
+    The expiry sweep pushes back entries modified since they were
+    scheduled, so thumbnails in use are not deleted and re-rendered.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+class ThumbnailCache:
+    """Renders thumbnails on demand into a content-addressed folder"""
+
+    def __init__(self, folder, pool, width=200, expiry=None, ttl=24 * 3600):
+        self.folder = folder
+        self.pool = pool
+        self.width = width
+        self.expiry = expiry
+        self.ttl = ttl
+        self._rendering = {}  # thumbnail path -> Event set when its render ends
+        self._lock = threading.Lock()
+        self._prewarm = ThreadPoolExecutor(max_workers=1)
+
+    def path(self, digest, page_index):
+        return os.path.join(self.folder, digest[:2], f"{digest}-{page_index + 1}-{self.width}.png")
+
+    def get_many(self, items):
+        """Thumbnail paths for (pdf path, digest, page index) items
+
+        Missing thumbnails are rendered on the pool; a thumbnail that could
+        not be rendered gives None. Served thumbnails get their expiry
+        extended, like merge outputs served from the result cache.
+        """
+        results = [None] * len(items)
+        claimed = []   # (result index, job) rendered by this call
+        waiting = []   # (result index, thumbnail path, event) rendered by another
+        with self._lock:
+            for i, (pdf_path, digest, page_index) in enumerate(items):
+                dest = self.path(digest, page_index)
+                if _touch(dest):
+                    results[i] = dest
+                elif dest in self._rendering:
+                    waiting.append((i, dest, self._rendering[dest]))
+                else:
+                    self._rendering[dest] = threading.Event()
+                    claimed.append((i, (pdf_path, page_index, dest, self.width)))
+
+        if claimed:
+            try:
+                for _, job in claimed:
+                    os.makedirs(os.path.dirname(job[2]), exist_ok=True)
+                rendered = self.pool.map(render_thumbnail, [job for _, job in claimed])
+                for (i, job), outcome in zip(claimed, rendered):
+                    if isinstance(outcome, Exception):
+                        log.warning('Thumbnail of %s page %s failed: %s', job[0], job[1] + 1, outcome)
+                        continue
+                    results[i] = outcome
+                    if self.expiry is not None:
+                        self.expiry.schedule(outcome, self.ttl, kind='thumbnail')
+            finally:
+                with self._lock:
+                    for _, job in claimed:
+                        self._rendering.pop(job[2]).set()
+
+        for i, dest, event in waiting:
+            event.wait()
+            if os.path.exists(dest):
+                results[i] = dest
+        return results
+
+    def get(self, pdf_path, digest, page_index=0):
+        return self.get_many([(pdf_path, digest, page_index)])[0]
+
+    def prewarm(self, items):
+        """Render items in the background, e.g. first pages right after an upload"""
+        if items and renderer_available():
+            self._prewarm.submit(self._prewarm_batch, list(items))
+
+    def _prewarm_batch(self, items):
+        try:
+            self.get_many(items)
+        except Exception as e:
+            log.warning('Thumbnail prewarm failed: %s', e)